@@ -0,0 +1,74 @@
+"""
+Import-time regression check for the pipeline package
+
+Runs `python -X importtime -c "import <module>"` in a fresh interpreter and
+fails if the cumulative import time exceeds the budget or if any of the heavy
+optional dependencies (plotting, scipy, pandas, the database driver) are
+imported eagerly. Short-lived workers pay this cost on every start-up.
+
+Usage:
+    python -m photonics_db.pipelines.check_import_time [--budget-ms 1000]
+"""
+
+import re
+import subprocess
+import sys
+
+default_module = "photonics_db.pipelines.wdm"
+default_budget_ms = 1000
+lazy_modules = ("matplotlib", "scipy", "pandas", "psycopg2")
+
+
+def measure_import_time(module: str = default_module) -> dict[str, int]:
+    """Return the cumulative import time (us) of every module imported."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    # Lines look like "import time:   self [us] | cumulative | imported package"
+    pattern = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+    timings = {}
+    for line in proc.stderr.splitlines():
+        match = pattern.match(line)
+        if match:
+            timings[match.group(4)] = int(match.group(2))
+
+    return timings
+
+
+def check_import_time(
+    module: str = default_module, budget_ms: float = default_budget_ms
+) -> tuple[float, list[str]]:
+    """Return the import time (ms) and a list of violations (empty on success)."""
+    timings = measure_import_time(module)
+    violations = []
+
+    total_ms = timings.get(module, 0) / 1000
+    if total_ms > budget_ms:
+        violations.append(
+            f"import {module} took {total_ms:0.0f}ms (budget {budget_ms:0.0f}ms)"
+        )
+
+    for name in lazy_modules:
+        if name in timings:
+            violations.append(f"import {module} eagerly imports {name}")
+
+    return total_ms, violations
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default=default_module)
+    parser.add_argument("--budget-ms", type=float, default=default_budget_ms)
+    args = parser.parse_args()
+
+    total_ms, violations = check_import_time(args.module, args.budget_ms)
+    print(f"import {args.module}: {total_ms:0.0f}ms")
+    for violation in violations:
+        print(violation)
+    sys.exit(1 if violations else 0)
@@ -4,10 +4,13 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 
 from photonics_db import database_address
+from photonics_db.pipelines.migrate_wdm_tables import migrate_wdm_tables
 from photonics_db.pipelines.wdm import (
     create_devices_table,
     create_fit_table,
     create_measurements_table,
+    create_qc_table,
+    create_resonance_table,
     create_sweep_deembed_table,
     create_sweep_main_table,
     create_sweep_raw_table,
@@ -19,6 +22,7 @@ from photonics_db.tables.wdm import *
 engine = create_engine(database_address + "/john_dev")
 # Base.metadata.drop_all(engine, checkfirst=True)
 # Base.metadata.create_all(engine, checkfirst=True)
+migrate_wdm_tables(engine)
 
 directories = [
     Path("/Users/jrollinson/projects/PRB/PEGASUS2/IBB38132/R2P0E380PLC5/WDM"),
@@ -52,7 +56,13 @@ with Session(engine) as session:
         print("De-embedding gratings for raw WDM sweeps.")
         create_sweep_main_table(session)
 
+        print("Screening WDM sweeps before fitting.")
+        create_qc_table(session)
+
         print("Extracting fit data for WDM peaks.")
         create_fit_table(session)
 
+        print("Tracking WDM resonances across bias and temperature.")
+        create_resonance_table(session)
+
     print("Database upload complete.")
@@ -0,0 +1,73 @@
+"""
+Bring an existing PEGASUS2 schema up to date with the table definitions
+
+create_wdm_tables never creates or alters tables, so columns added to existing
+tables must be added to existing databases by hand. Every migration below is
+idempotent (ADD COLUMN IF NOT EXISTS, DROP NOT NULL), so this can be run any
+number of times, e.g.
+    python -m photonics_db.pipelines.migrate_wdm_tables --database <address>
+
+Run it before any pipeline stage that uses the new columns.
+"""
+
+import sqlalchemy as sa
+
+# (description, statement), applied in order
+migrations = [
+    (
+        "archive_path of archived raw sweeps",
+        """
+        ALTER TABLE "PEGASUS2".wdm_sweep_raw
+            ADD COLUMN IF NOT EXISTS archive_path varchar,
+            ALTER COLUMN wavelength_nm DROP NOT NULL,
+            ALTER COLUMN transmission_db DROP NOT NULL
+        """,
+    ),
+    (
+        "archive_path of archived de-embed sweeps",
+        """
+        ALTER TABLE "PEGASUS2".wdm_sweep_deembed
+            ADD COLUMN IF NOT EXISTS archive_path varchar,
+            ALTER COLUMN wavelength_nm DROP NOT NULL,
+            ALTER COLUMN transmission_db DROP NOT NULL
+        """,
+    ),
+    (
+        "fit_nfev of fits",
+        """
+        ALTER TABLE "PEGASUS2".wdm_fit
+            ADD COLUMN IF NOT EXISTS fit_nfev integer
+        """,
+    ),
+    (
+        "fit failures of unscreened sweeps",
+        """
+        ALTER TABLE IF EXISTS "PEGASUS2".wdm_sweep_qc
+            ALTER COLUMN n_peaks DROP NOT NULL,
+            ALTER COLUMN deembed_fallback DROP NOT NULL,
+            ALTER COLUMN passed DROP NOT NULL
+        """,
+    ),
+]
+
+
+def migrate_wdm_tables(engine: sa.Engine):
+    """Apply all migrations in a single transaction."""
+    with engine.begin() as connection:
+        for description, statement in migrations:
+            print(f"Migrating {description} ...", end=" ", flush=True)
+            connection.execute(sa.text(statement))
+            print("Done.")
+    print("Completed.")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from photonics_db import database_address
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database", default=database_address + "/john_dev")
+    args = parser.parse_args()
+
+    migrate_wdm_tables(sa.create_engine(args.database))
@@ -1,6 +1,9 @@
+from .archive_sweeps import archive_sweeps
 from .create_devices_table import create_devices_table
 from .create_fit_table import create_fit_table
 from .create_measurements_table import create_measurements_table
+from .create_qc_table import create_qc_table
+from .create_resonance_table import create_resonance_table
 from .create_sweep_deembed_table import create_sweep_deembed_table
 from .create_sweep_main_table import create_sweep_main_table
 from .create_sweep_raw_table import create_sweep_raw_table
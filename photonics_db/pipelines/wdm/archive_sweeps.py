@@ -0,0 +1,159 @@
+"""
+Move the raw and de-embed spectra of completed wafers to cold storage
+
+Once a wafer has been de-embedded and fit, wdm_sweep_raw and wdm_sweep_deembed
+are rarely read, but they are the largest tables of the schema. This stage
+writes the spectra of each completed wafer to one compressed columnar file per
+table (see photonics_db/tables/archive.py), verifies the file by reading it
+back, and only then sets the arrays in the database to NULL and records the
+archive_path. Archived spectra are read back transparently, so e.g. re-running
+create_sweep_main_table still works.
+
+Archiving a wafer again (e.g. after new sweeps were uploaded) rewrites its file
+with both the previously archived and the new sweeps.
+
+Existing databases need the archive_path columns (and nullable spectra) of
+wdm_sweep_raw and wdm_sweep_deembed, see photonics_db.pipelines.migrate_wdm_tables.
+"""
+
+import time
+
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from photonics_db.tables.archive import SweepArchive, write_archive
+from photonics_db.tables.base import Base
+from photonics_db.tables.spectra import load_spectra
+from photonics_db.tables.wdm import (
+    WDMFitData,
+    WDMMeasurements,
+    WDMSweepDeembed,
+    WDMSweepMain,
+    WDMSweepRaw,
+)
+
+
+def completed_wafers(session: Session) -> list[str]:
+    """Return the wafers whose raw sweeps are all de-embedded and that have fits."""
+    fitted = session.scalars(
+        sa.select(WDMMeasurements.wafer_id)
+        .distinct()
+        .join(WDMFitData, WDMFitData.measurement_id == WDMMeasurements.measurement_id)
+    ).all()
+    pending = session.scalars(
+        sa.select(WDMMeasurements.wafer_id)
+        .distinct()
+        .join(WDMSweepRaw, WDMSweepRaw.measurement_id == WDMMeasurements.measurement_id)
+        .outerjoin(
+            WDMSweepMain,
+            (WDMSweepMain.measurement_id == WDMSweepRaw.measurement_id)
+            & (WDMSweepMain.sweep_id == WDMSweepRaw.sweep_id),
+        )
+        .where(WDMSweepMain.measurement_id.is_(None))
+    ).all()
+
+    return sorted(set(fitted) - set(pending))
+
+
+def archive_table(
+    session: Session, table: type[Base], archive_path: str, *filters
+) -> int:
+    """Archive the spectra of the rows of table matching the filters.
+
+    All matching rows, including previously archived ones, are written to
+    archive_path. Returns the number of newly archived rows.
+    """
+    spectra = load_spectra(session, *filters, table=table)
+    metadata = spectra.metadata
+    hot = np.array([path is None for path in metadata["archive_path"]], dtype=bool)
+    if not hot.any():
+        return 0
+
+    key_names = [column.name for column in sa.inspect(table).primary_key]
+    keys = {name: np.array(metadata[name].tolist()) for name in key_names}
+    key_values = list(zip(*[keys[name].tolist() for name in key_names]))
+    n_points = metadata["n_points"]
+    wavelength_nm = [row[:n] for row, n in zip(spectra.wavelength_nm, n_points)]
+    transmission_db = [row[:n] for row, n in zip(spectra.transmission_db, n_points)]
+    path = write_archive(archive_path, keys, wavelength_nm, transmission_db)
+
+    # Verify the file before dropping the spectra from the database
+    archive = SweepArchive(path)
+    for i, key in enumerate(key_values):
+        wavelength, transmission = archive[key]
+        if not (
+            np.array_equal(wavelength, wavelength_nm[i], equal_nan=True)
+            and np.array_equal(transmission, transmission_db[i], equal_nan=True)
+        ):
+            raise RuntimeError(
+                f"Archive {path} does not match {table.__name__} {key}"
+            )
+
+    session.execute(
+        sa.update(table),
+        [
+            dict(
+                **dict(zip(key_names, key_values[i])),
+                wavelength_nm=None,
+                transmission_db=None,
+                archive_path=archive_path,
+            )
+            for i in np.flatnonzero(hot)
+        ],
+    )
+
+    return int(hot.sum())
+
+
+def archive_sweeps(session: Session, wafer_ids: list[str] | None = None):
+    """Archive the raw and de-embed spectra of completed wafers."""
+    if wafer_ids is None:
+        wafer_ids = completed_wafers(session)
+
+    for k, wafer_id in enumerate(wafer_ids):
+        start = time.time()
+        print(
+            f"Archiving sweeps for {wafer_id} ({k+1}/{len(wafer_ids)}) ...",
+            end=" ",
+            flush=True,
+        )
+        n_raw = archive_table(
+            session,
+            WDMSweepRaw,
+            f"{WDMSweepRaw.__tablename__}/{wafer_id}.npz",
+            WDMMeasurements.wafer_id == wafer_id,
+        )
+
+        # De-embed sweeps belong to the wafer through the sweeps they de-embed
+        n_deembed = archive_table(
+            session,
+            WDMSweepDeembed,
+            f"{WDMSweepDeembed.__tablename__}/{wafer_id}.npz",
+            WDMSweepDeembed.deembed_id.in_(
+                sa.select(WDMSweepMain.deembed_id)
+                .join(
+                    WDMMeasurements,
+                    WDMMeasurements.measurement_id == WDMSweepMain.measurement_id,
+                )
+                .where(WDMMeasurements.wafer_id == wafer_id)
+            ),
+        )
+
+        print("Committing transactions ...", end=" ", flush=True)
+        session.commit()
+        print(
+            f"{n_raw} raw and {n_deembed} de-embed sweeps archived "
+            f"({time.time() - start:0.1f}s)."
+        )
+    print("Completed.")
+
+
+if __name__ == "__main__":
+    from sqlalchemy import create_engine
+
+    from photonics_db import database_address
+
+    engine = create_engine(database_address + "/john_dev")
+    with Session(engine) as sess:
+        archive_sweeps(sess)
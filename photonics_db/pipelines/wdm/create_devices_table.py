@@ -5,7 +5,6 @@ A simple script for uploading the WDM DOE metadata to a database table
 from pathlib import Path
 
 import numpy as np
-import pandas as pd
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import Session
 
@@ -13,6 +12,7 @@ from photonics_db.tables.wdm import WDMDevices
 
 
 def create_devices_table(session: Session):
+    import pandas as pd
 
     # Load and clean the WDM DOE table data
     devices_file = Path(__file__).parent / Path("wdm_devices.csv")
@@ -23,23 +23,28 @@ Data reduction procedure:
    parameters. Cross talk measured at lambda_resonant + 2.5nm
 """
 
-import math
-import sys
 import time
 
-import matplotlib.pyplot as plt
 import numpy as np
 import sqlalchemy as sa
-from scipy import optimize, signal
 from sqlalchemy.orm import Session
 
+from photonics_db.tables.spectra import load_spectra
 from photonics_db.tables.wdm import *
+from photonics_db.tables.writer import BatchedUpsertWriter
+
+from .precision import resolve_dtype
+from .preprocess_sweeps import as_spectra, downsample_spectra
 
 target_wavelength_nm = 1580
 target_bandwidth_1db_nm = 0.374
 target_crosstalk_offset_nm = 2.5
 target_fsr_nm = 12.8
 
+# Fit window of the "warm" fit strategy
+fit_window_fwhm = 5
+min_fit_points = 7
+
 
 def lorentzian(x, x0, alpha, gamma):
     numer = alpha * gamma
@@ -49,9 +54,9 @@ def lorentzian(x, x0, alpha, gamma):
 
 def extract_peaks(transmission_db: np.ndarray) -> np.ndarray:
     """Extract the peak indices of the ring resonator spectrum."""
+    from scipy import signal
+
     transmission_w = 10 ** (np.array(transmission_db) / 10)
-    # plt.plot(transmission_w)
-    # plt.show()
     peaks, _ = signal.find_peaks(transmission_w, prominence=0.5)
 
     return peaks
@@ -70,36 +75,120 @@ def extract_fsr(wavelength_nm: np.ndarray, peaks: list[int]) -> np.ndarray:
     return fsr_nm
 
 
+def estimate_lorentzian(
+    wavelength_nm: np.ndarray,
+    transmission_w: np.ndarray,
+    peak: int,
+    search_idx: int,
+) -> tuple[float, float, float]:
+    """Estimate the Lorentzian parameters of a resonance from its samples.
+
+    lambda_0 is the sampled peak wavelength and gamma is half the FWHM measured
+    at the (linearly interpolated) half-maximum crossings within search_idx
+    samples of the peak (the reference guess of 0.35 if neither is found). alpha
+    follows from the peak height, L(lambda_0) = alpha / gamma.
+    """
+    height = transmission_w[peak]
+    half_max = height / 2
+
+    # Half-maximum crossings on either side of the peak
+    crossings = []
+    left = transmission_w[max(peak - search_idx, 0) : peak + 1]
+    below = np.flatnonzero(left < half_max)
+    if below.size:
+        i = peak - left.size + 1 + below[-1]
+        crossings.append(
+            np.interp(half_max, transmission_w[i : i + 2], wavelength_nm[i : i + 2])
+        )
+    right = transmission_w[peak : peak + search_idx + 1]
+    below = np.flatnonzero(right < half_max)
+    if below.size:
+        i = peak + below[0]
+        crossings.append(
+            np.interp(
+                half_max,
+                transmission_w[i - 1 : i + 1][::-1],
+                wavelength_nm[i - 1 : i + 1][::-1],
+            )
+        )
+
+    if crossings:
+        gamma = np.mean(np.abs(np.array(crossings) - wavelength_nm[peak]))
+    else:
+        gamma = 0.35
+
+    return wavelength_nm[peak], height * gamma, gamma
+
+
 def extract_lorentzian_fit(
-    wavelength_nm: np.ndarray, transmission_db: np.ndarray, peak: int, peaks: np.ndarray
-) -> tuple[np.ndarray, np.ndarray, float]:
+    wavelength_nm: np.ndarray,
+    transmission_db: np.ndarray,
+    peak: int,
+    peaks: np.ndarray,
+    strategy: str = "fixed",
+    previous: np.ndarray | None = None,
+) -> tuple[np.ndarray, np.ndarray, float, dict]:
     """Fit a (un-normalized) Lorentzian to the drop port of a ring resonator.
 
     Lorentzian:
         L(lambda) = alpha * gamma^2 / ((lambda - lambda_0)^2 + gamma^2)
+
+    Fit strategies:
+    - "fixed": the reference fit, starting from p0=(lambda_peak, 0.9, 0.35) in a
+      window of +/- half the mean peak spacing.
+    - "warm": starts from the previous solution (previous resonance or
+      neighbouring sweep), i.e. its alpha and gamma with lambda_0 at the sampled
+      peak, or without one from the analytic estimate of estimate_lorentzian.
+      The window is +/- fit_window_fwhm starting linewidths (at least
+      min_fit_points samples, at most the "fixed" window).
+
+    Returns the fit parameters, their covariance, the r-square and the fit info
+    (number of function evaluations). curve_fit raises a RuntimeError if the
+    optimizer does not converge, so every returned fit has converged and
+    convergence is not stored: a non-converged fit has no WDMFitData row and is
+    only visible in the fit failures recorded by create_fit_table.
     """
+    from scipy import optimize
+
     fsr_idx = np.mean(np.roll(peaks, -1)[:-1] - peaks[:-1])
     transmission_w = 10 ** (np.array(transmission_db) / 10)
     wavelength_nm = np.array(wavelength_nm)
 
     # Slice out the peak of interest for fitting
-    start_idx = max(int(peak - fsr_idx // 2), 0)
-    stop_idx = min(int(peak + fsr_idx // 2), wavelength_nm.size)
+    half_window_idx = fsr_idx // 2
+    if strategy == "fixed":
+        p0 = (wavelength_nm[peak], 0.9, 0.35)
+        kwargs = dict(sigma=1e-12)
+    elif strategy == "warm":
+        if previous is not None:
+            # (-alpha, -gamma) is the same Lorentzian as (alpha, gamma)
+            _, alpha, gamma = previous
+            p0 = (wavelength_nm[peak], abs(alpha), abs(gamma))
+        else:
+            p0 = estimate_lorentzian(
+                wavelength_nm, transmission_w, peak, int(half_window_idx)
+            )
+        step_nm = abs(wavelength_nm[-1] - wavelength_nm[0]) / (wavelength_nm.size - 1)
+        linewidth_idx = max(fit_window_fwhm * 2 * p0[2] / step_nm, min_fit_points)
+        half_window_idx = min(half_window_idx, np.ceil(linewidth_idx))
+        kwargs = dict()
+    else:
+        raise ValueError(f"Unrecognized fit strategy '{strategy}'")
+    start_idx = max(int(peak - half_window_idx), 0)
+    stop_idx = min(int(peak + half_window_idx), wavelength_nm.size)
+    # The fit window is promoted to float64 for the optimizer and covariance
     wlen_fit = wavelength_nm[start_idx:stop_idx]
-    trans_fit = transmission_w[start_idx:stop_idx]
+    trans_fit = transmission_w[start_idx:stop_idx].astype(np.float64)
 
-    popt, pcov = optimize.curve_fit(
+    popt, pcov, infodict, _, _ = optimize.curve_fit(
         lorentzian,
         wlen_fit,
         trans_fit,
-        p0=(wavelength_nm[peak], 0.9, 0.35),
-        sigma=1e-12,
+        p0=p0,
+        full_output=True,
+        **kwargs,
     )
-
-    # plt.plot(wlen_fit, trans_fit)
-    # plt.plot(wlen_fit, lorentzian(wlen_fit, *popt), label=f"{popt}")
-    # plt.legend()
-    # plt.show()
+    info = dict(nfev=int(infodict["nfev"]))
 
     # Compute r-square for Lorentzian fit
     residuals = trans_fit - lorentzian(wlen_fit, *popt)
@@ -107,7 +196,7 @@ def extract_lorentzian_fit(
     ss_tot = np.sum(np.square(trans_fit - np.mean(trans_fit)))
     r_squared = 1 - ss_res / ss_tot
 
-    return popt, pcov, r_squared
+    return popt, pcov, r_squared, info
 
 
 def extract_fwhm(fit_params: list[float]) -> float:
@@ -148,73 +237,204 @@ def extract_insertion_loss(fit_params) -> float:
     return -10 * np.log10(alpha / gamma)
 
 
-def create_fit_table(session: Session):
-
-    # Determine the number of WDM measurements
-    row_count = session.scalar(
-        sa.select(sa.func.count())
-        .select_from(WDMSweepMain)
-        .where(WDMSweepMain.port_type == "drop")
+def fit_sweep(
+    measurement_id: int,
+    sweep_id: int,
+    wavelength_nm: np.ndarray,
+    transmission_db: np.ndarray,
+    downsample_factor: int = 1,
+    dtype: np.dtype = np.float64,
+    strategy: str = "fixed",
+    seeds: list[np.ndarray] | None = None,
+) -> tuple[list[dict], list[str]]:
+    """Fit every resonance of a single drop-port sweep.
+
+    The transmission is processed as dtype (float64 or float32). With the
+    "warm" fit strategy, each fit is seeded with the previous resonance's
+    solution, or for the first resonance with the closest of the seeds (e.g.
+    the fits of a neighbouring sweep).
+
+    Returns one WDMFitData row (as a dict) per resonance, and the errors of the
+    resonances whose fit failed (these are skipped).
+    """
+    wavelength_nm, transmission_db = downsample_spectra(
+        as_spectra(wavelength_nm, np.float64),
+        as_spectra(transmission_db, dtype),
+        downsample_factor,
     )
+    peaks = extract_peaks(transmission_db)
+    peaks_fsr_nm = extract_fsr(wavelength_nm, peaks)
+
+    previous = None
+    if seeds:
+        seeds = np.array(seeds)
+        if peaks.size:
+            previous = seeds[np.argmin(np.abs(seeds[:, 0] - wavelength_nm[peaks[0]]))]
+
+    rows, errors = [], []
+    for i, (peak, fsr_nm) in enumerate(zip(peaks, peaks_fsr_nm)):
+        try:
+            popt, pcov, rsquared, info = extract_lorentzian_fit(
+                wavelength_nm, transmission_db, peak, peaks, strategy, previous
+            )
+        except (RuntimeError, ValueError, TypeError) as e:
+            errors.append(f"resonance {i}: {e}")
+            continue
+        previous = popt
+        rows.append(
+            dict(
+                measurement_id=measurement_id,
+                sweep_id=sweep_id,
+                resonance_id=i,
+                peak_wavelength_nm=wavelength_nm[peak],
+                fsr_nm=None if np.isnan(fsr_nm) else fsr_nm,
+                fwhm_nm=extract_fwhm(popt),
+                bw_1db_nm=extract_1db_bandwidth(popt),
+                crosstalk_db=extract_crosstalk(popt),
+                insertion_loss_db=extract_insertion_loss(popt),
+                fit_params=popt,
+                fit_covars=pcov,
+                fit_rsquared=rsquared,
+                fit_nfev=info["nfev"],
+            )
+        )
 
-    # Batch parameters
-    batch_size = 100
-    n_batches = math.ceil(row_count / batch_size)
-    offset = 0
-    start_batch = offset // batch_size
-
-    for k in range(start_batch, n_batches):
+    return rows, errors
+
+
+def create_fit_table(
+    session: Session,
+    downsample_factor: int = 1,
+    measurement_ids: list[int] | None = None,
+    page_size: int = 5000,
+    precision: str = "float64",
+    qc_gate: bool = True,
+    fit_strategy: str = "fixed",
+):
+    """Fit every resonance of the de-embedded drop-port sweeps.
+
+    A downsample_factor > 1 block-averages each sweep before peak finding and
+    fitting, e.g. 10 turns 10pm data into 100pm data for fast preview fits.
+    Preview fits are written to WDMFitPreview (keyed by downsample_factor), so
+    they never overwrite the full-resolution fits in WDMFitData.
+    If measurement_ids is given, only sweeps of those measurements are fit.
+    Sweeps are loaded one wafer at a time with load_spectra, as a contiguous
+    batch of the given precision ("float32" halves the memory and bandwidth,
+    see precision.py). Fits are written with multi-row upserts of page_size
+    rows.
+
+    If qc_gate is set, sweeps that failed create_qc_table are skipped. Sweeps
+    that have not been screened (create_qc_table has not run on them) are still
+    fit, with a warning. The number of failed resonance fits and their errors
+    are recorded in the QC row of every fit sweep, with or without qc_gate; an
+    unscreened sweep gets a QC row with NULL metrics and passed.
+
+    fit_strategy="warm" seeds every fit from the previous resonance (or the
+    previous sweep of the same measurement) and fits a window sized by the
+    estimated linewidth instead of the whole FSR (see extract_lorentzian_fit).
+    """
+    dtype = resolve_dtype(precision)
+    filters = [WDMSweepMain.port_type == "drop"]
+    if measurement_ids is not None:
+        filters.append(WDMSweepMain.measurement_id.in_(measurement_ids))
+    if qc_gate:
+        qc_match = (WDMSweepQC.measurement_id == WDMSweepMain.measurement_id) & (
+            WDMSweepQC.sweep_id == WDMSweepMain.sweep_id
+        )
+        n_unscreened = session.scalar(
+            sa.select(sa.func.count())
+            .select_from(WDMSweepMain)
+            .where(
+                *filters,
+                ~sa.exists().where(qc_match & WDMSweepQC.passed.is_not(None)),
+            )
+        )
+        if n_unscreened:
+            print(
+                f"Warning: {n_unscreened} drop sweeps have not been screened by "
+                "create_qc_table and are fit without the QC gate."
+            )
+        filters.append(~sa.exists().where(qc_match & ~WDMSweepQC.passed))
+
+    wafer_ids = session.scalars(
+        sa.select(WDMMeasurements.wafer_id)
+        .distinct()
+        .join(
+            WDMSweepMain,
+            WDMSweepMain.measurement_id == WDMMeasurements.measurement_id,
+        )
+        .where(*filters)
+    ).all()
 
+    preview = downsample_factor > 1
+    writer = BatchedUpsertWriter(
+        session, WDMFitPreview if preview else WDMFitData, page_size=page_size
+    )
+    # Fit failures update the QC row, or insert one for unscreened sweeps
+    failure_writer = BatchedUpsertWriter(
+        session,
+        WDMSweepQC,
+        page_size=page_size,
+        update_columns=["fit_failures", "fit_error"],
+    )
+    for k, wafer_id in enumerate(wafer_ids):
         start = time.time()
         print(
-            f"Batching rows {offset}-{offset+batch_size} ({k+1}/{n_batches}) ...",
+            f"Fitting sweeps for {wafer_id} ({k+1}/{len(wafer_ids)}) ...",
             end=" ",
             flush=True,
         )
 
-        # Fetch a batch of WDM_RR measurements
-        wdm_rr_results = session.scalars(
-            sa.select(WDMSweepMain)
-            .where(WDMSweepMain.port_type == "drop")
-            .offset(offset)
-            .limit(batch_size)
-        ).all()
-        offset += batch_size
-
-        for result in wdm_rr_results:
-            peaks = extract_peaks(result.transmission_db)
-            peaks_fsr_nm = extract_fsr(result.wavelength_nm, peaks)
-            for i, (peak, fsr_nm) in enumerate(zip(peaks, peaks_fsr_nm)):
-                popt, pcov, rsquared = extract_lorentzian_fit(
-                    result.wavelength_nm, result.transmission_db, peak, peaks
-                )
-                fsr_nm = None if np.isnan(fsr_nm) else fsr_nm
-                peak_wavelength_nm = result.wavelength_nm[peak]
-                fwhm_nm = extract_fwhm(popt)
-                bw_1db_nm = extract_1db_bandwidth(popt)
-                crosstalk_db = extract_crosstalk(popt)
-                insertion_loss_db = extract_insertion_loss(popt)
-
-                fit_data = WDMFitData(
-                    measurement_id=result.measurement_id,
-                    sweep_id=result.sweep_id,
-                    resonance_id=i,
-                    peak_wavelength_nm=peak_wavelength_nm,
-                    fsr_nm=fsr_nm,
-                    fwhm_nm=fwhm_nm,
-                    bw_1db_nm=bw_1db_nm,
-                    crosstalk_db=crosstalk_db,
-                    insertion_loss_db=insertion_loss_db,
-                    fit_params=popt,
-                    fit_covars=pcov,
-                    fit_rsquared=rsquared,
-                )
-
-                session.merge(fit_data)
+        # Load the wafer's drop-port sweeps as one contiguous batch of dtype
+        spectra = load_spectra(
+            session, *filters, WDMMeasurements.wafer_id == wafer_id, dtype=dtype
+        )
 
+        last_fits = {}
+        fit_failures = []
+        for i, meta in enumerate(spectra.metadata):
+            measurement_id = int(meta["measurement_id"])
+            sweep_id = int(meta["sweep_id"])
+            n_points = meta["n_points"]
+            rows, errors = fit_sweep(
+                measurement_id,
+                sweep_id,
+                spectra.wavelength_nm[i, :n_points],
+                spectra.transmission_db[i, :n_points],
+                downsample_factor,
+                dtype,
+                fit_strategy,
+                last_fits.get(measurement_id),
+            )
+            if rows:
+                last_fits[measurement_id] = [row["fit_params"] for row in rows]
+            for row in rows:
+                if preview:
+                    row["downsample_factor"] = downsample_factor
+                writer.add(row)
+            fit_failures.append(
+                dict(
+                    measurement_id=measurement_id,
+                    sweep_id=sweep_id,
+                    fit_failures=len(errors),
+                    fit_error="; ".join(errors) or None,
+                )
+            )
+
+        print("Writing fits ...", end=" ", flush=True)
+        writer.flush()
+        if not preview:
+            for failure in fit_failures:
+                failure_writer.add(failure)
+            failure_writer.flush()
+        n_failed = sum(failure["fit_failures"] for failure in fit_failures)
+        if n_failed:
+            print(f"{n_failed} fits failed ...", end=" ", flush=True)
         print("Committing transactions ...", end=" ", flush=True)
         session.commit()
-        print(f"Batch complete ({time.time() - start:0.1f}s).")
+        print(
+            f"{len(spectra.metadata)} sweeps fit ({time.time() - start:0.1f}s)."
+        )
     print("Completed.")
 
 
@@ -0,0 +1,220 @@
+"""
+Screen de-embedded drop-port sweeps before fitting
+
+Bad sweeps (fiber misalignment, flat spectra, saturated detectors, de-embed
+fallbacks) still cost a peak search and many curve_fit calls, and usually give
+junk fits. This stage computes cheap quality metrics, vectorized over each
+wafer's (n_sweeps x n_points) batch of spectra, and stores them together with a
+pass/fail flag in wdm_sweep_qc. create_fit_table skips the failing sweeps.
+
+Metrics:
+- max_transmission_db: peak transmission; too low indicates fiber misalignment
+- noise_floor_db: 10th percentile of the transmission (off-resonance floor)
+- dynamic_range_db: max_transmission_db - noise_floor_db; too low for flat
+  spectra
+- saturated_fraction: fraction of adjacent sample pairs that are both within
+  saturation_tolerance_db of the maximum; a clipped (saturated) peak has a flat
+  top, while an unsaturated peak has at most one sample at its maximum
+- n_peaks: number of regions where the linear transmission rises more than
+  peak_prominence above the floor, compared against the expected_peaks from the
+  wavelength span and target FSR
+- deembed_fallback: the sweep was de-embedded with a same-die GCDE measurement
+  of the wrong DOE column
+"""
+
+import time
+
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from photonics_db.tables.spectra import load_spectra
+from photonics_db.tables.wdm import (
+    WDMDevices,
+    WDMMeasurements,
+    WDMSweepDeembed,
+    WDMSweepMain,
+    WDMSweepQC,
+)
+from photonics_db.tables.writer import BatchedUpsertWriter
+
+from .create_fit_table import target_fsr_nm
+
+min_max_transmission_db = -30
+min_dynamic_range_db = 3
+max_saturated_fraction = 0.005
+saturation_tolerance_db = 0.01
+peak_prominence = 0.5
+peak_count_tolerance = 0.5
+
+
+def compute_qc_metrics(
+    wavelength_nm: np.ndarray, transmission_db: np.ndarray
+) -> dict[str, np.ndarray]:
+    """Compute the QC metrics of a NaN-padded (n_sweeps x n_points) batch."""
+    with np.errstate(invalid="ignore"):
+        max_transmission_db = np.nanmax(transmission_db, axis=1)
+        noise_floor_db = np.nanpercentile(transmission_db, 10, axis=1)
+        dynamic_range_db = max_transmission_db - noise_floor_db
+
+        n_points = np.sum(~np.isnan(transmission_db), axis=1)
+        saturated = transmission_db >= (
+            max_transmission_db[:, None] - saturation_tolerance_db
+        )
+        flat_top = saturated[:, 1:] & saturated[:, :-1]
+        saturated_fraction = flat_top.sum(axis=1) / np.maximum(n_points, 1)
+
+        # Count the contiguous regions rising above the floor (in linear scale)
+        transmission_w = 10 ** (transmission_db / 10)
+        floor_w = 10 ** (noise_floor_db / 10)
+        above = (transmission_w - floor_w[:, None]) >= peak_prominence
+        rising = above[:, 1:] & ~above[:, :-1]
+        n_peaks = rising.sum(axis=1) + above[:, 0]
+
+        span_nm = np.nanmax(wavelength_nm, axis=1) - np.nanmin(wavelength_nm, axis=1)
+        expected_peaks = span_nm / target_fsr_nm
+
+    return dict(
+        max_transmission_db=max_transmission_db,
+        noise_floor_db=noise_floor_db,
+        dynamic_range_db=dynamic_range_db,
+        saturated_fraction=saturated_fraction,
+        n_peaks=n_peaks,
+        expected_peaks=expected_peaks,
+    )
+
+
+def screen_sweeps(
+    metrics: dict[str, np.ndarray],
+    deembed_fallback: np.ndarray,
+    reject_deembed_fallback: bool = False,
+) -> tuple[np.ndarray, list[str | None]]:
+    """Apply the QC thresholds, returning the pass flags and failure reasons."""
+    n_peaks = metrics["n_peaks"]
+    expected_peaks = metrics["expected_peaks"]
+    checks = {
+        "no data": np.isnan(metrics["max_transmission_db"]),
+        "low transmission": metrics["max_transmission_db"] < min_max_transmission_db,
+        "flat spectrum": metrics["dynamic_range_db"] < min_dynamic_range_db,
+        "saturated": metrics["saturated_fraction"] > max_saturated_fraction,
+        "no peaks": n_peaks == 0,
+        "unexpected peak count": np.abs(n_peaks - expected_peaks)
+        > peak_count_tolerance * expected_peaks + 1,
+    }
+    if reject_deembed_fallback:
+        checks["de-embed fallback"] = deembed_fallback
+
+    failed = np.stack(list(checks.values()), axis=1)
+    names = np.array(list(checks))
+    reasons = [", ".join(names[row]) or None for row in failed]
+
+    return ~failed.any(axis=1), reasons
+
+
+def _deembed_fallbacks(session: Session, *filters) -> dict[tuple[int, int], bool]:
+    """Look up which sweeps were de-embedded with a fallback GCDE measurement."""
+    query = (
+        sa.select(
+            WDMSweepMain.measurement_id,
+            WDMSweepMain.sweep_id,
+            WDMSweepDeembed.doe_column != WDMDevices.doe_column + 1,
+        )
+        .join(WDMSweepDeembed, WDMSweepDeembed.deembed_id == WDMSweepMain.deembed_id)
+        .join(
+            WDMMeasurements,
+            WDMMeasurements.measurement_id == WDMSweepMain.measurement_id,
+        )
+        .join(WDMDevices, WDMDevices.device_id == WDMMeasurements.device_id)
+    )
+    for clause in filters:
+        query = query.where(clause)
+
+    return {(mid, sid): fallback for mid, sid, fallback in session.execute(query)}
+
+
+def create_qc_table(
+    session: Session,
+    measurement_ids: list[int] | None = None,
+    reject_deembed_fallback: bool = False,
+    page_size: int = 5000,
+):
+    """Screen all drop-port sweeps, one wafer per batch."""
+    filters = [WDMSweepMain.port_type == "drop"]
+    if measurement_ids is not None:
+        filters.append(WDMSweepMain.measurement_id.in_(measurement_ids))
+
+    wafer_ids = session.scalars(
+        sa.select(WDMMeasurements.wafer_id)
+        .distinct()
+        .join(WDMSweepMain, WDMSweepMain.measurement_id == WDMMeasurements.measurement_id)
+        .where(*filters)
+    ).all()
+
+    # Keep the fit failures recorded by create_fit_table
+    writer = BatchedUpsertWriter(
+        session,
+        WDMSweepQC,
+        page_size=page_size,
+        update_columns=[
+            column.name
+            for column in sa.inspect(WDMSweepQC).columns
+            if column.name not in ("fit_failures", "fit_error")
+        ],
+    )
+    for k, wafer_id in enumerate(wafer_ids):
+        start = time.time()
+        print(
+            f"Screening sweeps for {wafer_id} ({k+1}/{len(wafer_ids)}) ...",
+            end=" ",
+            flush=True,
+        )
+        wafer_filters = filters + [WDMMeasurements.wafer_id == wafer_id]
+        spectra = load_spectra(session, *wafer_filters)
+        fallbacks = _deembed_fallbacks(session, *wafer_filters)
+
+        metrics = compute_qc_metrics(spectra.wavelength_nm, spectra.transmission_db)
+        deembed_fallback = np.array(
+            [
+                fallbacks.get((meta["measurement_id"], meta["sweep_id"]), False)
+                for meta in spectra.metadata
+            ],
+            dtype=bool,
+        )
+        passed, reasons = screen_sweeps(
+            metrics, deembed_fallback, reject_deembed_fallback
+        )
+
+        for i, meta in enumerate(spectra.metadata):
+            writer.add(
+                dict(
+                    measurement_id=meta["measurement_id"],
+                    sweep_id=meta["sweep_id"],
+                    **{
+                        name: None if np.isnan(values[i]) else values[i]
+                        for name, values in metrics.items()
+                        if name != "n_peaks"
+                    },
+                    n_peaks=metrics["n_peaks"][i],
+                    deembed_fallback=deembed_fallback[i],
+                    passed=passed[i],
+                    reason=reasons[i],
+                )
+            )
+
+        print("Committing transactions ...", end=" ", flush=True)
+        writer.flush()
+        session.commit()
+        print(
+            f"{passed.sum()}/{passed.size} passed ({time.time() - start:0.1f}s)."
+        )
+    print("Completed.")
+
+
+if __name__ == "__main__":
+    from sqlalchemy import create_engine
+
+    from photonics_db import database_address
+
+    engine = create_engine(database_address + "/john_dev")
+    with Session(engine) as sess:
+        create_qc_table(sess)
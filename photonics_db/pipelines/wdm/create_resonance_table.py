@@ -0,0 +1,339 @@
+"""
+Track resonances across bias and temperature sweeps
+
+create_fit_table numbers the resonances of each sweep independently, so the
+same physical resonance has a different resonance_id in every heater/bias sweep
+of a measurement. This stage assigns stable resonance identities:
+
+1. Bias tracking: the drop-port sweeps of each measurement are ordered by heater
+   power (voltage_v * current_ma, in mW) and every resonance is matched to the
+   mutual nearest track of the earlier sweeps, by the track's last known
+   wavelength, provided it moved less than max_shift_nm. A resonance missing
+   from a sweep (e.g. a failed fit) therefore does not split its track. Matched
+   resonances form a track, numbered per measurement in order of their
+   wavelength in the lowest-power sweep (track_id).
+2. Tuning efficiency (nm/mW): least-squares slope of the resonance wavelength
+   vs. heater power over each track.
+3. Thermal tracking: measurements of the same die and device are ordered by
+   temperature and their tracks are matched the same way, using each track's
+   reference (lowest-power) wavelength. Matched tracks share a
+   thermal_track_id, numbered per die and device in order of their wavelength
+   at the lowest temperature, which identifies the resonance across
+   temperatures.
+4. Thermal shift (nm/K): least-squares slope of the reference wavelength vs.
+   temperature over each thermally matched group of tracks.
+
+The matching and the fits are vectorized over a whole wafer; the only Python
+loop is over the position in the (bias or temperature) ordering.
+"""
+
+import time
+
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from photonics_db.tables.wdm import (
+    WDMFitData,
+    WDMMeasurements,
+    WDMResonance,
+    WDMResonanceTrack,
+    WDMSweepRaw,
+)
+from photonics_db.tables.writer import BatchedUpsertWriter
+
+from .create_fit_table import target_fsr_nm
+
+
+def _float_array(values) -> np.ndarray:
+    return np.array([np.nan if v is None else v for v in values], dtype=float)
+
+
+def _none_if_nan(value: float) -> float | None:
+    return None if np.isnan(value) else float(value)
+
+
+def _rank_within_group(group: np.ndarray, key: np.ndarray) -> np.ndarray:
+    """Return the 0-based rank of every element by key within its group."""
+    sort = np.lexsort((key, group))
+    first = np.r_[True, group[sort][1:] != group[sort][:-1]]
+    group_start = np.maximum.accumulate(np.where(first, np.arange(group.size), 0))
+    rank = np.empty(group.size, dtype=int)
+    rank[sort] = np.arange(group.size) - group_start
+
+    return rank
+
+
+def track_chains(
+    group: np.ndarray,
+    order: np.ndarray,
+    wavelength_nm: np.ndarray,
+    max_shift_nm: float,
+) -> np.ndarray:
+    """Label resonances that follow each other along ordered chains of spectra.
+
+    group and order are (n_items,) arrays and wavelength_nm is a NaN-padded
+    (n_items x n_peaks) array of resonance wavelengths. Within each group, items
+    are ordered by `order` and each resonance is matched to the mutual nearest
+    track of the group, by the track's last known wavelength, if it is within
+    max_shift_nm. Tracks stay open when a resonance is missing from an item
+    (e.g. its fit failed), so they continue across the gap.
+
+    Returns (n_items x n_peaks) labels, unique across all groups, with -1 for
+    padding.
+    """
+    n_items, n_peaks = wavelength_nm.shape
+    present = ~np.isnan(wavelength_nm)
+    _, group_index = np.unique(group, return_inverse=True)
+    group_index = group_index.ravel()
+    n_groups = group_index.max() + 1 if n_items else 0
+    depth = _rank_within_group(group_index, order)
+
+    # Group and last known wavelength of every track
+    label_group = np.empty(0, dtype=int)
+    label_wavelength_nm = np.empty(0)
+
+    # Match the items of all groups against their open tracks, one depth level
+    # at a time
+    labels = np.full((n_items, n_peaks), -1)
+    for d in range(depth.max() + 1 if n_items else 0):
+        items = np.flatnonzero(depth == d)
+        current = wavelength_nm[items]
+        item_labels = np.full((items.size, n_peaks), -1)
+
+        # Open tracks of every item's group, as a -1 padded (items x tracks) array
+        item_row = np.full(n_groups, -1)
+        item_row[group_index[items]] = np.arange(items.size)
+        track_row = item_row[label_group]
+        open_tracks = np.flatnonzero(track_row >= 0)
+        if open_tracks.size:
+            track_col = _rank_within_group(track_row[open_tracks], open_tracks)
+            tracks = np.full((items.size, track_col.max() + 1), -1)
+            tracks[track_row[open_tracks], track_col] = open_tracks
+            last = np.where(tracks >= 0, label_wavelength_nm[tracks], np.nan)
+
+            # Mutual nearest-neighbour matches of peaks and tracks
+            distance = np.abs(current[:, :, None] - last[:, None, :])
+            distance[np.isnan(distance)] = np.inf
+            forward = distance.argmin(axis=2)
+            backward = distance.argmin(axis=1)
+            mutual = np.take_along_axis(backward, forward, axis=1) == np.arange(
+                n_peaks
+            )
+            nearest = np.take_along_axis(distance, forward[:, :, None], axis=2)[..., 0]
+            matched = mutual & (nearest <= max_shift_nm)
+            item_labels[matched] = np.take_along_axis(tracks, forward, axis=1)[matched]
+
+        # Unmatched resonances start new tracks
+        new = present[items] & (item_labels < 0)
+        item_labels[new] = label_group.size + np.arange(new.sum())
+        label_group = np.r_[
+            label_group, np.broadcast_to(group_index[items][:, None], new.shape)[new]
+        ]
+        label_wavelength_nm = np.r_[label_wavelength_nm, np.empty(new.sum())]
+        assigned = item_labels >= 0
+        label_wavelength_nm[item_labels[assigned]] = current[assigned]
+        labels[items] = item_labels
+
+    return labels
+
+
+def group_slope(
+    labels: np.ndarray, x: np.ndarray, y: np.ndarray, n_labels: int
+) -> np.ndarray:
+    """Least-squares slope dy/dx for every label, NaN where x does not vary."""
+    n = np.bincount(labels, minlength=n_labels)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x_mean = np.bincount(labels, x, minlength=n_labels) / n
+        y_mean = np.bincount(labels, y, minlength=n_labels) / n
+        dx = x - x_mean[labels]
+        dy = y - y_mean[labels]
+        sxx = np.bincount(labels, dx * dx, minlength=n_labels)
+        sxy = np.bincount(labels, dx * dy, minlength=n_labels)
+        slope = sxy / sxx
+    slope[(n < 2) | ~(sxx > 1e-12)] = np.nan
+
+    return slope
+
+
+def track_wafer(session: Session, wafer_id: str, max_shift_nm: float):
+    """Track the resonances of one wafer, returning the resonance and track rows."""
+    result = session.execute(
+        sa.select(
+            WDMFitData.measurement_id,
+            WDMFitData.sweep_id,
+            WDMFitData.resonance_id,
+            WDMFitData.peak_wavelength_nm,
+            WDMSweepRaw.voltage_v,
+            WDMSweepRaw.current_ma,
+            WDMMeasurements.die_id,
+            WDMMeasurements.device_id,
+            WDMMeasurements.temperature,
+        )
+        .join(
+            WDMSweepRaw,
+            (WDMSweepRaw.measurement_id == WDMFitData.measurement_id)
+            & (WDMSweepRaw.sweep_id == WDMFitData.sweep_id),
+        )
+        .join(
+            WDMMeasurements,
+            WDMMeasurements.measurement_id == WDMFitData.measurement_id,
+        )
+        .where(WDMMeasurements.wafer_id == wafer_id)
+    ).all()
+    if not result:
+        return [], []
+
+    columns = list(zip(*result))
+    measurement_id = np.array(columns[0], dtype=np.int64)
+    sweep_id = np.array(columns[1], dtype=np.int64)
+    resonance_id = np.array(columns[2], dtype=int)
+    peak_wavelength_nm = np.array(columns[3], dtype=float)
+    power_mw = np.nan_to_num(_float_array(columns[4]) * _float_array(columns[5]))
+    die_device = np.array([f"{die}|{device}" for die, device in zip(*columns[6:8])])
+    temperature = np.array(columns[8], dtype=float)
+
+    # Index the sweeps and measurements of the wafer
+    sweep_keys, sweep_index = np.unique(
+        np.stack([measurement_id, sweep_id], axis=1), axis=0, return_inverse=True
+    )
+    sweep_index = sweep_index.ravel()
+    meas_keys, meas_index = np.unique(measurement_id, return_inverse=True)
+    sweep_meas = np.empty(len(sweep_keys), dtype=int)
+    sweep_meas[sweep_index] = meas_index
+    sweep_power = np.empty(len(sweep_keys))
+    sweep_power[sweep_index] = power_mw
+
+    # 1. Track resonances across the heater/bias sweeps of each measurement
+    peaks = np.full((len(sweep_keys), resonance_id.max() + 1), np.nan)
+    peaks[sweep_index, resonance_id] = peak_wavelength_nm
+    bias_labels = track_chains(sweep_meas, sweep_power, peaks, max_shift_nm)
+    label = bias_labels[sweep_index, resonance_id]
+    n_labels = label.max() + 1
+
+    # Reference wavelength of each track is its wavelength at the lowest power
+    sort = np.lexsort((power_mw, label))
+    first = np.r_[True, label[sort][1:] != label[sort][:-1]]
+    reference_wavelength_nm = np.empty(n_labels)
+    reference_wavelength_nm[label[sort][first]] = peak_wavelength_nm[sort][first]
+    label_meas = np.empty(n_labels, dtype=int)
+    label_meas[label] = meas_index
+    track_id = _rank_within_group(label_meas, reference_wavelength_nm)
+
+    # 2. Tuning efficiency from the wavelength vs. heater power of each track
+    tuning_efficiency = group_slope(label, power_mw, peak_wavelength_nm, n_labels)
+
+    # 3. Track resonances across temperatures of the same die and device
+    meas_temperature = np.empty(len(meas_keys))
+    meas_temperature[meas_index] = temperature
+    _, meas_group = np.unique(die_device, return_inverse=True)
+    meas_die_device = np.empty(len(meas_keys), dtype=int)
+    meas_die_device[meas_index] = meas_group.ravel()
+
+    references = np.full((len(meas_keys), track_id.max() + 1), np.nan)
+    references[label_meas, track_id] = reference_wavelength_nm
+    thermal_labels = track_chains(
+        meas_die_device, meas_temperature, references, max_shift_nm
+    )
+    thermal_label = thermal_labels[label_meas, track_id]
+    n_thermal_labels = thermal_label.max() + 1
+
+    # Number the thermal tracks per die and device by their wavelength at the
+    # lowest temperature
+    track_temperature = meas_temperature[label_meas]
+    sort = np.lexsort((track_temperature, thermal_label))
+    first = np.r_[True, thermal_label[sort][1:] != thermal_label[sort][:-1]]
+    thermal_wavelength_nm = np.empty(n_thermal_labels)
+    thermal_wavelength_nm[thermal_label[sort][first]] = reference_wavelength_nm[
+        sort
+    ][first]
+    thermal_group = np.empty(n_thermal_labels, dtype=int)
+    thermal_group[thermal_label] = meas_die_device[label_meas]
+    thermal_track_id = _rank_within_group(thermal_group, thermal_wavelength_nm)[
+        thermal_label
+    ]
+
+    # 4. Thermal shift from the reference wavelength vs. temperature
+    thermal_shift = group_slope(
+        thermal_label, track_temperature, reference_wavelength_nm, n_thermal_labels
+    )[thermal_label]
+
+    n_sweeps = np.bincount(label, minlength=n_labels)
+    resonances = [
+        dict(
+            measurement_id=meas_keys[label_meas[i]],
+            track_id=track_id[i],
+            reference_wavelength_nm=reference_wavelength_nm[i],
+            n_sweeps=n_sweeps[i],
+            tuning_efficiency_nm_per_mw=_none_if_nan(tuning_efficiency[i]),
+            thermal_shift_nm_per_k=_none_if_nan(thermal_shift[i]),
+            thermal_track_id=thermal_track_id[i],
+        )
+        for i in range(n_labels)
+    ]
+    wavelength_shift_nm = peak_wavelength_nm - reference_wavelength_nm[label]
+    tracks = [
+        dict(
+            measurement_id=measurement_id[i],
+            sweep_id=sweep_id[i],
+            resonance_id=resonance_id[i],
+            track_id=track_id[label[i]],
+            heater_power_mw=power_mw[i],
+            wavelength_shift_nm=wavelength_shift_nm[i],
+        )
+        for i in range(len(result))
+    ]
+
+    return resonances, tracks
+
+
+def create_resonance_table(
+    session: Session,
+    wafer_ids: list[str] | None = None,
+    max_shift_nm: float = target_fsr_nm / 2,
+    page_size: int = 5000,
+):
+    """Assign stable resonance identities and tuning coefficients per wafer."""
+    if wafer_ids is None:
+        wafer_ids = session.scalars(
+            sa.select(WDMMeasurements.wafer_id)
+            .distinct()
+            .join(
+                WDMFitData,
+                WDMFitData.measurement_id == WDMMeasurements.measurement_id,
+            )
+        ).all()
+
+    resonance_writer = BatchedUpsertWriter(session, WDMResonance, page_size=page_size)
+    track_writer = BatchedUpsertWriter(session, WDMResonanceTrack, page_size=page_size)
+
+    for k, wafer_id in enumerate(wafer_ids):
+        start = time.time()
+        print(
+            f"Tracking resonances for {wafer_id} ({k+1}/{len(wafer_ids)}) ...",
+            end=" ",
+            flush=True,
+        )
+        resonances, tracks = track_wafer(session, wafer_id, max_shift_nm)
+
+        # The tracks reference the resonances, so write those first
+        print("Committing transactions ...", end=" ", flush=True)
+        for row in resonances:
+            resonance_writer.add(row)
+        resonance_writer.flush()
+        for row in tracks:
+            track_writer.add(row)
+        track_writer.flush()
+        session.commit()
+        print(f"Wafer complete ({time.time() - start:0.1f}s).")
+    print("Completed.")
+
+
+if __name__ == "__main__":
+    from sqlalchemy import create_engine
+
+    from photonics_db import database_address
+
+    engine = create_engine(database_address + "/john_dev")
+    with Session(engine) as sess:
+        create_resonance_table(sess)
@@ -1,7 +1,6 @@
 import json
 from pathlib import Path
 
-import pandas as pd
 from sqlalchemy.orm import Session
 
 from photonics_db.tables.wdm import WDMSweepDeembed
@@ -10,6 +9,8 @@ wrap_io = lambda x: int((x - 1) % 3 + 1)
 
 
 def create_sweep_deembed_table(session: Session, directory: Path):
+    import pandas as pd
+
     for filename in directory.rglob("*GCDE*.csv"):
         with open(filename, "r") as f:
             line = str(f.readline()).replace(",}", "}")
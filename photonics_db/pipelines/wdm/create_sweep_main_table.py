@@ -1,9 +1,6 @@
 import math
-import sys
 import time
 
-import matplotlib.pyplot as plt
-import numpy as np
 import sqlalchemy as sa
 from sqlalchemy.exc import NoResultFound
 from sqlalchemy.orm import Session
@@ -15,16 +12,34 @@ from photonics_db.tables.wdm import (
     WDMSweepMain,
     WDMSweepRaw,
 )
+from photonics_db.tables.writer import BatchedUpsertWriter
+
+from .precision import resolve_dtype
+from .preprocess_sweeps import deembed_spectra
 
 
 # Connect to the database
-def create_sweep_main_table(session: Session):
+def create_sweep_main_table(
+    session: Session,
+    smoothing: str | None = None,
+    measurement_ids: list[int] | None = None,
+    page_size: int = 5000,
+    precision: str = "float64",
+    smoothing_kwargs: dict | None = None,
+):
+    dtype = resolve_dtype(precision)
+    query = sa.select(WDMSweepRaw)
+    if measurement_ids is not None:
+        query = query.where(WDMSweepRaw.measurement_id.in_(measurement_ids))
 
     # Determine the number of raw WDM sweeps to de-embed
-    row_count = session.scalar(sa.select(sa.func.count()).select_from(WDMSweepRaw))
+    row_count = session.scalar(
+        sa.select(sa.func.count()).select_from(query.subquery())
+    )
 
     # Batch parameters
     batch_size = 100
+    writer = BatchedUpsertWriter(session, WDMSweepMain, page_size=page_size)
     offset = 0
     n_batches = math.ceil(row_count / batch_size)
     start_batch = offset // batch_size
@@ -39,13 +54,12 @@ def create_sweep_main_table(session: Session):
             end=" ",
             flush=True,
         )
-        result = session.scalars(
-            sa.select(WDMSweepRaw).offset(offset).limit(batch_size)
-        )
+        result = session.scalars(query.offset(offset).limit(batch_size))
         offset += batch_size
 
         # Iterate over batch rows to de-embed each measurement
         print(f"Fetching de-embed entries ...", end=" ", flush=True)
+        matches = []
         for raw_sweep in result:
             # Fetch measurement metadata
             meas = session.scalars(
@@ -78,14 +92,6 @@ def create_sweep_main_table(session: Session):
                     )
                 ).one()
 
-            # De-embed grating coupler from raw measurement
-            # plt.plot(raw_sweep.transmission_db)
-            # plt.plot(deembed_meas.transmission_db)
-            # plt.show()
-            transmission_db = np.array(raw_sweep.transmission_db) - np.array(
-                deembed_meas.transmission_db
-            )
-
             # Determine where the measurement is a thru port or a drop port
             # For drop port, we want (orientation=V, output=3) | (orientation=H, output=2)
             # For thru port, we want (orientation=V, output=2) | (orientation=H, output=3)
@@ -102,19 +108,39 @@ def create_sweep_main_table(session: Session):
                     f"Unrecognized port type for measurement_id={raw_sweep.measurement_id}"
                 )
 
+            matches.append((raw_sweep, deembed_meas, port_type))
+
+        # De-embed grating couplers from the whole batch of raw measurements
+        print(f"De-embedding ...", end=" ", flush=True)
+        deembedded = deembed_spectra(
+            [raw_sweep.wavelength_nm for raw_sweep, _, _ in matches],
+            [raw_sweep.transmission_db for raw_sweep, _, _ in matches],
+            [deembed_meas.wavelength_nm for _, deembed_meas, _ in matches],
+            [deembed_meas.transmission_db for _, deembed_meas, _ in matches],
+            smoothing=smoothing,
+            dtype=dtype,
+            smoothing_kwargs=smoothing_kwargs,
+        )
+
+        for (raw_sweep, deembed_meas, port_type), transmission_db in zip(
+            matches, deembedded
+        ):
             # Create the new main sweep entry from the de-embedded transmission
-            new_entry = WDMSweepMain(
-                measurement_id=raw_sweep.measurement_id,
-                sweep_id=raw_sweep.sweep_id,
-                deembed_id=deembed_meas.deembed_id,
-                port_type=port_type,
-                current_ma=None,
-                voltage_v=None,
-                wavelength_nm=raw_sweep.wavelength_nm,
-                transmission_db=transmission_db,
+            writer.add(
+                dict(
+                    measurement_id=raw_sweep.measurement_id,
+                    sweep_id=raw_sweep.sweep_id,
+                    deembed_id=deembed_meas.deembed_id,
+                    port_type=port_type,
+                    current_ma=None,
+                    voltage_v=None,
+                    wavelength_nm=raw_sweep.wavelength_nm,
+                    transmission_db=transmission_db,
+                )
             )
-            session.merge(new_entry)
 
+        print("Writing sweeps ...", end=" ", flush=True)
+        writer.flush()
         print("Committing transactions ...", end=" ", flush=True)
         session.commit()
         print(f"Batch complete ({time.time() - start:0.1f})")
@@ -1,7 +1,6 @@
 import sys
 from pathlib import Path
 
-import pandas as pd
 import sqlalchemy as sa
 from sqlalchemy.orm import Session
 
@@ -11,6 +10,8 @@ wrap_io = lambda x: int((x - 1) % 3 + 1)
 
 
 def create_sweep_raw_table(session: Session, directory: Path):
+    import pandas as pd
+
     files = list(directory.rglob("*EULER*.csv"))
     batch_size = 100
 
@@ -1,7 +1,6 @@
 from pathlib import Path
 
 import numpy as np
-import pandas as pd
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import Session
 
@@ -9,6 +8,7 @@ from photonics_db.tables.wdm import WaferMetadata
 
 
 def create_wafer_table(session: Session):
+    import pandas as pd
 
     wafer_metadata_file = Path(__file__).parent / Path("wafer_metadata.csv")
     wafer_metadata = pd.read_csv(wafer_metadata_file, sep=",", header=0)
@@ -0,0 +1,408 @@
+"""
+Diagnostic plots for the WDM pipeline
+
+Plots are rendered off the critical path from results already stored in the
+database, never from inside the ingest or fitting loops:
+1. Fit overlays: de-embedded drop-port spectrum with every Lorentzian fit of the
+   sweep, for a sampled or filtered (e.g. low fit_rsquared) subset of sweeps.
+2. De-embed comparisons: raw sweep, GCDE sweep and de-embedded result.
+3. FOM maps: per-wafer and per-device die maps of the median FOM of the
+   resonance closest to the target wavelength, for unheated sweeps at the base
+   temperature.
+
+The database queries run in the calling process, while the figures are rendered
+to PNG with the non-interactive Agg backend in a process pool. An index.html
+linking all rendered images is written to the output directory.
+
+matplotlib is only imported when a plot is requested, so the pipeline stages
+never pay its import cost.
+"""
+
+import html
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from photonics_db.tables.wdm import (
+    WDMFitData,
+    WDMMeasurements,
+    WDMSweepDeembed,
+    WDMSweepMain,
+    WDMSweepRaw,
+)
+
+from .create_fit_table import lorentzian, target_fsr_nm, target_wavelength_nm
+
+fom_columns = ("insertion_loss_db", "fwhm_nm", "bw_1db_nm", "crosstalk_db", "fsr_nm")
+
+
+def _init_worker():
+    import matplotlib
+
+    matplotlib.use("Agg")
+
+
+def _new_figure(**kwargs):
+    from matplotlib.figure import Figure
+
+    return Figure(figsize=(10, 5), layout="tight", **kwargs)
+
+
+def _render_fit_overlay(
+    path: Path,
+    title: str,
+    wavelength_nm: np.ndarray,
+    transmission_db: np.ndarray,
+    fit_params: list[np.ndarray],
+    fit_rsquared: list[float],
+    max_rsquared: float | None,
+) -> Path:
+    wavelength_nm = np.asarray(wavelength_nm)
+    transmission_w = 10 ** (np.asarray(transmission_db) / 10)
+
+    fig = _new_figure()
+    ax = fig.subplots()
+    ax.plot(wavelength_nm, transmission_w, color="0.6", lw=1, label="data")
+    for popt, rsquared in zip(fit_params, fit_rsquared):
+        lambda_0, _, gamma = popt[:3]
+        window = np.abs(wavelength_nm - lambda_0) < 10 * abs(gamma)
+        flagged = max_rsquared is not None and rsquared < max_rsquared
+        ax.plot(
+            wavelength_nm[window],
+            lorentzian(wavelength_nm[window], *popt[:3]),
+            color="tab:red" if flagged else "tab:blue",
+            lw=1.5,
+        )
+        ax.annotate(
+            f"{rsquared:0.3f}",
+            (lambda_0, lorentzian(lambda_0, *popt[:3])),
+            fontsize=7,
+            ha="center",
+            va="bottom",
+        )
+    ax.set_title(title)
+    ax.set_xlabel("Wavelength (nm)")
+    ax.set_ylabel("Transmission (W/W)")
+    fig.savefig(path, dpi=100)
+
+    return path
+
+
+def _render_deembed(
+    path: Path,
+    title: str,
+    wavelength_nm: np.ndarray,
+    raw_transmission_db: np.ndarray,
+    deembed_wavelength_nm: np.ndarray,
+    deembed_transmission_db: np.ndarray,
+    main_transmission_db: np.ndarray,
+) -> Path:
+    fig = _new_figure()
+    ax_raw, ax_main = fig.subplots(2, 1, sharex=True)
+    ax_raw.plot(wavelength_nm, raw_transmission_db, label="raw")
+    ax_raw.plot(deembed_wavelength_nm, deembed_transmission_db, label="GCDE")
+    ax_raw.set_ylabel("Transmission (dB)")
+    ax_raw.set_title(title)
+    ax_raw.legend()
+    ax_main.plot(wavelength_nm, main_transmission_db, label="de-embedded")
+    ax_main.set_xlabel("Wavelength (nm)")
+    ax_main.set_ylabel("Transmission (dB)")
+    ax_main.legend()
+    fig.savefig(path, dpi=100)
+
+    return path
+
+
+def _render_fom_map(
+    path: Path,
+    title: str,
+    rows: np.ndarray,
+    columns: np.ndarray,
+    values: np.ndarray,
+) -> Path:
+    rows = np.asarray(rows, dtype=int)
+    columns = np.asarray(columns, dtype=int)
+    shape = (rows.max() - rows.min() + 1, columns.max() - columns.min() + 1)
+    grid = np.full(shape, np.nan)
+    grid[rows - rows.min(), columns - columns.min()] = values
+
+    fig = _new_figure()
+    ax = fig.subplots()
+    image = ax.imshow(
+        grid,
+        origin="lower",
+        extent=(
+            columns.min() - 0.5,
+            columns.max() + 0.5,
+            rows.min() - 0.5,
+            rows.max() + 0.5,
+        ),
+    )
+    fig.colorbar(image, ax=ax)
+    ax.set_title(title)
+    ax.set_xlabel("Die column")
+    ax.set_ylabel("Die row")
+    fig.savefig(path, dpi=100)
+
+    return path
+
+
+def write_html_index(output_dir: Path, images: list[Path], title: str) -> Path:
+    """Write an index.html displaying all images in the output directory."""
+    output_dir = Path(output_dir)
+    sections = "\n".join(
+        f'<figure><img src="{html.escape(str(image.relative_to(output_dir)))}">'
+        f"<figcaption>{html.escape(image.stem)}</figcaption></figure>"
+        for image in sorted(images)
+    )
+    index = output_dir / "index.html"
+    index.write_text(
+        f"<!DOCTYPE html>\n<html><head><title>{html.escape(title)}</title></head>\n"
+        f"<body><h1>{html.escape(title)}</h1>\n{sections}\n</body></html>\n"
+    )
+
+    return index
+
+
+def _sample(query: sa.Select, sample_size: int | None) -> sa.Select:
+    if sample_size is None:
+        return query
+    return query.order_by(sa.func.random()).limit(sample_size)
+
+
+def render_fit_overlays(
+    session: Session,
+    executor: ProcessPoolExecutor,
+    output_dir: Path,
+    wafer_id: str | None = None,
+    max_rsquared: float | None = None,
+    sample_size: int | None = 100,
+) -> list:
+    """Submit fit overlay plots for a sample of fitted sweeps.
+
+    If max_rsquared is given, only sweeps with at least one fit below it are
+    selected and those fits are highlighted.
+    """
+    output_dir = Path(output_dir) / "fits"
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    query = sa.select(WDMFitData.measurement_id, WDMFitData.sweep_id).distinct()
+    if max_rsquared is not None:
+        query = query.where(WDMFitData.fit_rsquared < max_rsquared)
+    if wafer_id is not None:
+        query = query.join(
+            WDMMeasurements,
+            WDMMeasurements.measurement_id == WDMFitData.measurement_id,
+        ).where(WDMMeasurements.wafer_id == wafer_id)
+    keys = session.execute(_sample(query.subquery().select(), sample_size)).all()
+
+    futures = []
+    for measurement_id, sweep_id in keys:
+        sweep = session.get(WDMSweepMain, (measurement_id, sweep_id))
+        fits = session.scalars(
+            sa.select(WDMFitData)
+            .where(WDMFitData.measurement_id == measurement_id)
+            .where(WDMFitData.sweep_id == sweep_id)
+            .order_by(WDMFitData.resonance_id)
+        ).all()
+        futures.append(
+            executor.submit(
+                _render_fit_overlay,
+                output_dir / f"fit_{measurement_id}_{sweep_id}.png",
+                f"measurement_id={measurement_id}, sweep_id={sweep_id}",
+                np.asarray(sweep.wavelength_nm),
+                np.asarray(sweep.transmission_db),
+                [np.asarray(fit.fit_params) for fit in fits],
+                [fit.fit_rsquared for fit in fits],
+                max_rsquared,
+            )
+        )
+        session.expunge_all()
+
+    return futures
+
+
+def render_deembed_comparisons(
+    session: Session,
+    executor: ProcessPoolExecutor,
+    output_dir: Path,
+    wafer_id: str | None = None,
+    sample_size: int | None = 50,
+) -> list:
+    """Submit raw vs. GCDE vs. de-embedded plots for a sample of sweeps."""
+    output_dir = Path(output_dir) / "deembed"
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    query = sa.select(WDMSweepMain.measurement_id, WDMSweepMain.sweep_id)
+    if wafer_id is not None:
+        query = query.join(
+            WDMMeasurements,
+            WDMMeasurements.measurement_id == WDMSweepMain.measurement_id,
+        ).where(WDMMeasurements.wafer_id == wafer_id)
+    keys = session.execute(_sample(query, sample_size)).all()
+
+    futures = []
+    for measurement_id, sweep_id in keys:
+        main = session.get(WDMSweepMain, (measurement_id, sweep_id))
+        raw = session.get(WDMSweepRaw, (measurement_id, sweep_id))
+        deembed = session.get(WDMSweepDeembed, main.deembed_id)
+        futures.append(
+            executor.submit(
+                _render_deembed,
+                output_dir / f"deembed_{measurement_id}_{sweep_id}.png",
+                f"measurement_id={measurement_id}, sweep_id={sweep_id}, "
+                f"{main.port_type} port, {main.deembed_id}",
+                np.asarray(raw.wavelength_nm),
+                np.asarray(raw.transmission_db),
+                np.asarray(deembed.wavelength_nm),
+                np.asarray(deembed.transmission_db),
+                np.asarray(main.transmission_db),
+            )
+        )
+        session.expunge_all()
+
+    return futures
+
+
+def render_fom_maps(
+    session: Session,
+    executor: ProcessPoolExecutor,
+    output_dir: Path,
+    wafer_id: str,
+    device_id: str | None = None,
+    temperature: int | None = None,
+    foms: tuple[str, ...] = fom_columns,
+) -> list:
+    """Submit die maps of the median FOMs of one wafer, one map per device.
+
+    Devices of different designs are never mixed in a map. Only unheated sweeps
+    (zero heater power) at one temperature (by default the lowest measured on
+    the wafer) and the resonances within half an FSR of the target wavelength
+    are used.
+    """
+    output_dir = Path(output_dir) / "maps"
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    if temperature is None:
+        temperature = session.scalar(
+            sa.select(sa.func.min(WDMMeasurements.temperature)).where(
+                WDMMeasurements.wafer_id == wafer_id
+            )
+        )
+
+    query = (
+        sa.select(
+            WDMMeasurements.device_id,
+            WDMMeasurements.row,
+            WDMMeasurements.column,
+            *[
+                sa.func.percentile_cont(0.5).within_group(getattr(WDMFitData, fom))
+                for fom in foms
+            ],
+        )
+        .join(
+            WDMMeasurements,
+            WDMMeasurements.measurement_id == WDMFitData.measurement_id,
+        )
+        .join(
+            WDMSweepRaw,
+            (WDMSweepRaw.measurement_id == WDMFitData.measurement_id)
+            & (WDMSweepRaw.sweep_id == WDMFitData.sweep_id),
+        )
+        .where(WDMMeasurements.wafer_id == wafer_id)
+        .where(WDMMeasurements.temperature == temperature)
+        .where(
+            sa.func.coalesce(WDMSweepRaw.voltage_v * WDMSweepRaw.current_ma, 0) == 0
+        )
+        .where(
+            sa.func.abs(WDMFitData.peak_wavelength_nm - target_wavelength_nm)
+            < target_fsr_nm / 2
+        )
+        .group_by(
+            WDMMeasurements.device_id, WDMMeasurements.row, WDMMeasurements.column
+        )
+        .order_by(WDMMeasurements.device_id)
+    )
+    if device_id is not None:
+        query = query.where(WDMMeasurements.device_id == device_id)
+    result = session.execute(query).all()
+
+    by_device = {}
+    for device, *values in result:
+        by_device.setdefault(device, []).append(values)
+
+    futures = []
+    for device, values in by_device.items():
+        data = np.array(values, dtype=float)
+        name = f"{wafer_id}_{device}_{temperature}C"
+        futures += [
+            executor.submit(
+                _render_fom_map,
+                output_dir / f"map_{name}_{fom}.png",
+                f"{wafer_id} {device} ({temperature}C, unheated): "
+                f"median {fom} @ {target_wavelength_nm}nm",
+                data[:, 0],
+                data[:, 1],
+                data[:, 2 + i],
+            )
+            for i, fom in enumerate(foms)
+        ]
+
+    return futures
+
+
+def render_diagnostics(
+    session: Session,
+    output_dir: Path,
+    wafer_id: str | None = None,
+    max_rsquared: float | None = None,
+    sample_size: int | None = 100,
+    processes: int | None = None,
+) -> Path:
+    """Render all diagnostic plots and return the path to the HTML index."""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    with ProcessPoolExecutor(processes, initializer=_init_worker) as executor:
+        futures = render_fit_overlays(
+            session, executor, output_dir, wafer_id, max_rsquared, sample_size
+        )
+        futures += render_deembed_comparisons(
+            session, executor, output_dir, wafer_id, sample_size
+        )
+        if wafer_id is not None:
+            futures += render_fom_maps(session, executor, output_dir, wafer_id)
+        images = [future.result() for future in futures]
+
+    return write_html_index(output_dir, images, f"WDM diagnostics {wafer_id or ''}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from sqlalchemy import create_engine
+
+    from photonics_db import database_address
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_dir", type=Path)
+    parser.add_argument("--wafer-id")
+    parser.add_argument("--max-rsquared", type=float)
+    parser.add_argument("--sample-size", type=int, default=100)
+    parser.add_argument("--processes", type=int)
+    args = parser.parse_args()
+
+    engine = create_engine(database_address + "/john_dev")
+    with Session(engine) as sess:
+        index = render_diagnostics(
+            sess,
+            args.output_dir,
+            wafer_id=args.wafer_id,
+            max_rsquared=args.max_rsquared,
+            sample_size=args.sample_size,
+            processes=args.processes,
+        )
+    print(f"Diagnostics written to {index}")
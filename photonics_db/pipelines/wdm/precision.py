@@ -0,0 +1,119 @@
+"""
+Floating point precision of the de-embed and fit stages
+
+The de-embed and fit stages are dominated by memory bandwidth (dB subtraction,
+the 10 ** (x/10) conversion and the residual sums), while the measurement noise
+is far above float32 resolution. With precision="float32" the transmission
+batches are kept as contiguous float32 arrays through de-embedding, peak
+finding and fitting, halving their memory and bandwidth. Precision-sensitive
+steps are still done in float64:
+- wavelength grids (float32 only resolves ~0.1pm near 1580nm),
+- the Lorentzian fit window, which scipy's curve_fit promotes to float64 for the
+  optimizer and the covariance estimate,
+- the r-square sums.
+The stored spectra remain float8[] in the database.
+
+compare_precision is the accuracy check for the float32 path: it fits the same
+sample of sweeps in both precisions and reports the FOM differences, e.g.
+    python -m photonics_db.pipelines.wdm.precision --wafer-id R2P0E438PLF7
+"""
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from photonics_db.tables.spectra import load_spectra
+from photonics_db.tables.wdm import WDMMeasurements, WDMSweepMain
+
+precisions = {
+    "float64": np.float64,
+    "float32": np.float32,
+}
+
+fom_columns = (
+    "peak_wavelength_nm",
+    "fsr_nm",
+    "fwhm_nm",
+    "bw_1db_nm",
+    "crosstalk_db",
+    "insertion_loss_db",
+    "fit_rsquared",
+)
+
+
+def resolve_dtype(precision: str) -> np.dtype:
+    try:
+        return np.dtype(precisions[precision])
+    except KeyError:
+        raise ValueError(f"Unrecognized precision '{precision}'") from None
+
+
+def compare_precision(
+    session: Session, *filters, sample_size: int = 100, seed: int = 0
+) -> dict[str, dict[str, float]]:
+    """Fit a sample of drop-port sweeps in float64 and float32 and compare FOMs.
+
+    Returns, for every FOM, the maximum and median absolute difference over all
+    resonances found in both precisions, plus the number of sweeps whose peak
+    count differs.
+    """
+    from .create_fit_table import fit_sweep
+
+    spectra = load_spectra(session, WDMSweepMain.port_type == "drop", *filters)
+    rng = np.random.default_rng(seed)
+    n_sweeps = len(spectra.metadata)
+    sample = rng.choice(n_sweeps, size=min(sample_size, n_sweeps), replace=False)
+
+    diffs = {fom: [] for fom in fom_columns}
+    peak_count_mismatches = 0
+    for i in sample:
+        meta = spectra.metadata[i]
+        n_points = meta["n_points"]
+        args = (
+            meta["measurement_id"],
+            meta["sweep_id"],
+            spectra.wavelength_nm[i, :n_points],
+            spectra.transmission_db[i, :n_points],
+        )
+        rows64, _ = fit_sweep(*args, dtype=np.float64)
+        rows32, _ = fit_sweep(*args, dtype=np.float32)
+        if len(rows64) != len(rows32):
+            peak_count_mismatches += 1
+            continue
+        for row64, row32 in zip(rows64, rows32):
+            for fom in fom_columns:
+                if row64[fom] is not None and row32[fom] is not None:
+                    diffs[fom].append(abs(row64[fom] - row32[fom]))
+
+    report = {
+        fom: {
+            "max_abs_diff": float(np.max(values)) if values else np.nan,
+            "median_abs_diff": float(np.median(values)) if values else np.nan,
+        }
+        for fom, values in diffs.items()
+    }
+    report["peak_count_mismatches"] = {"sweeps": peak_count_mismatches}
+
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from sqlalchemy import create_engine
+
+    from photonics_db import database_address
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wafer-id")
+    parser.add_argument("--sample-size", type=int, default=100)
+    args = parser.parse_args()
+
+    filters = []
+    if args.wafer_id is not None:
+        filters.append(WDMMeasurements.wafer_id == args.wafer_id)
+
+    engine = create_engine(database_address + "/john_dev")
+    with Session(engine) as sess:
+        report = compare_precision(sess, *filters, sample_size=args.sample_size)
+    for name, stats in report.items():
+        print(name, ", ".join(f"{key}={value:0.3g}" for key, value in stats.items()))
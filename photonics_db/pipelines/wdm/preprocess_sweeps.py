@@ -0,0 +1,205 @@
+"""
+Vectorized preprocessing of WDM transmission sweeps
+
+All functions operate along the last axis of (n_sweeps x n_points) arrays, so a
+whole batch of sweeps is handled by a single numpy/scipy call instead of one
+Python call per sweep.
+
+Preprocessing steps:
+1. Smoothing: Savitzky-Golay or FFT (Gaussian low-pass) smoothing of the
+   transmission data in dB.
+2. Resampling: linear interpolation onto a common wavelength grid, used when the
+   raw and GCDE wavelength grids do not line up index by index.
+3. Downsampling: block averaging (in linear power) by an integer factor, e.g.
+   to turn 10pm data into 100pm data for fast preview fits.
+
+Transmission arrays keep their floating point precision (float64 or float32,
+see precision.py) through every step. Wavelength grids are always float64:
+near 1580nm float32 only resolves ~0.1pm, which is the quantity we report.
+"""
+
+from typing import Sequence
+
+import numpy as np
+
+# Wavelength grids closer than this are considered identical
+grid_tolerance_nm = 1e-6
+
+
+def as_spectra(values, dtype: np.dtype | None = None) -> np.ndarray:
+    """Convert to a contiguous floating point array, keeping float32 as float32."""
+    array = np.ascontiguousarray(values, dtype=dtype)
+    if array.dtype.kind != "f":
+        array = array.astype(np.float64)
+    return array
+
+
+def smooth_spectra(
+    transmission_db: np.ndarray,
+    method: str = "savgol",
+    window_length: int = 11,
+    polyorder: int = 3,
+    cutoff: float = 0.05,
+) -> np.ndarray:
+    """Smooth a batch of spectra along the last axis.
+
+    method="savgol" applies a Savitzky-Golay filter with the given window length
+    and polynomial order. method="fft" applies a Gaussian low-pass filter in the
+    Fourier domain with a 1/e cutoff given in cycles/sample (0 < cutoff <= 0.5).
+    """
+    transmission_db = as_spectra(transmission_db)
+    dtype = transmission_db.dtype
+    n_points = transmission_db.shape[-1]
+
+    if method == "savgol":
+        from scipy import signal
+
+        # The window must be odd, longer than the polynomial order and no longer
+        # than the sweep itself
+        window_length = min(window_length, n_points - (1 - n_points % 2))
+        if window_length <= polyorder:
+            return transmission_db.copy()
+        smoothed = signal.savgol_filter(
+            transmission_db, window_length, polyorder, axis=-1, mode="interp"
+        )
+        return smoothed.astype(dtype, copy=False)
+    elif method == "fft":
+        # Remove the straight line between the end points before filtering so
+        # the implicit periodic extension has no step discontinuity (ringing)
+        ramp = np.linspace(0, 1, n_points)
+        first = transmission_db[..., :1]
+        last = transmission_db[..., -1:]
+        trend = first + (last - first) * ramp
+        spectrum = np.fft.rfft(transmission_db - trend, axis=-1)
+        freqs = np.fft.rfftfreq(n_points)
+        spectrum *= np.exp(-np.square(freqs / cutoff))
+        smoothed = np.fft.irfft(spectrum, n=n_points, axis=-1) + trend
+        return smoothed.astype(dtype, copy=False)
+    else:
+        raise ValueError(f"Unrecognized smoothing method '{method}'")
+
+
+def resample_spectra(
+    wavelength_nm: np.ndarray,
+    transmission_db: np.ndarray,
+    target_wavelength_nm: np.ndarray,
+) -> np.ndarray:
+    """Linearly interpolate a batch of spectra onto target wavelength grids.
+
+    wavelength_nm may be a single grid shared by all sweeps (n_points,) or one
+    grid per sweep (n_sweeps x n_points); likewise for target_wavelength_nm.
+    Values outside a sweep's wavelength range are clamped to its end points, as
+    with np.interp.
+    """
+    transmission_db = as_spectra(transmission_db)
+    squeeze = transmission_db.ndim == 1
+    transmission_db = np.atleast_2d(transmission_db)
+    n_sweeps = transmission_db.shape[0]
+
+    wavelength_nm = np.broadcast_to(
+        np.asarray(wavelength_nm, dtype=float), transmission_db.shape
+    )
+    target_wavelength_nm = np.asarray(target_wavelength_nm, dtype=float)
+    target_wavelength_nm = np.broadcast_to(
+        target_wavelength_nm, (n_sweeps, target_wavelength_nm.shape[-1])
+    )
+
+    # Clamp to each sweep's own range, then shift every sweep onto a disjoint,
+    # increasing interval so a single np.interp call handles the whole batch
+    target = np.clip(
+        target_wavelength_nm,
+        wavelength_nm[:, :1],
+        wavelength_nm[:, -1:],
+    )
+    lo = min(wavelength_nm.min(), target.min())
+    span = max(wavelength_nm.max(), target.max()) - lo + 1
+    offset = span * np.arange(n_sweeps)[:, None]
+
+    resampled = np.interp(
+        (target - lo + offset).ravel(),
+        (wavelength_nm - lo + offset).ravel(),
+        transmission_db.ravel(),
+    ).reshape(target.shape)
+    resampled = resampled.astype(transmission_db.dtype, copy=False)
+
+    return resampled[0] if squeeze else resampled
+
+
+def downsample_spectra(
+    wavelength_nm: np.ndarray, transmission_db: np.ndarray, factor: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Block-average a batch of spectra by an integer factor.
+
+    Transmission is averaged in linear power and converted back to dB. Trailing
+    points that do not fill a complete block are dropped.
+    """
+    wavelength_nm = as_spectra(wavelength_nm, np.float64)
+    transmission_db = as_spectra(transmission_db)
+    if factor <= 1:
+        return wavelength_nm, transmission_db
+
+    n_points = transmission_db.shape[-1] // factor * factor
+    blocks = (n_points // factor, factor)
+
+    wavelength_nm = wavelength_nm[..., :n_points]
+    wavelength_nm = wavelength_nm.reshape(wavelength_nm.shape[:-1] + blocks)
+    transmission_w = 10 ** (transmission_db[..., :n_points] / 10)
+    transmission_w = transmission_w.reshape(transmission_w.shape[:-1] + blocks)
+
+    return wavelength_nm.mean(axis=-1), 10 * np.log10(transmission_w.mean(axis=-1))
+
+
+def deembed_spectra(
+    wavelength_nm: Sequence[np.ndarray],
+    transmission_db: Sequence[np.ndarray],
+    deembed_wavelength_nm: Sequence[np.ndarray],
+    deembed_transmission_db: Sequence[np.ndarray],
+    smoothing: str | None = None,
+    dtype: np.dtype = np.float64,
+    smoothing_kwargs: dict | None = None,
+) -> list[np.ndarray]:
+    """De-embed a batch of raw sweeps against their GCDE reference sweeps.
+
+    Sweeps are grouped by length and each group is processed as a 2-D array.
+    Optionally both spectra are smoothed first (smooth_spectra with
+    method=smoothing and the options in smoothing_kwargs), and the GCDE
+    spectrum is resampled onto the raw wavelength grid wherever the two grids
+    differ.
+    Returns the de-embedded transmission (dB), as dtype, on the raw wavelength
+    grid.
+    """
+    if smoothing is None and smoothing_kwargs:
+        raise ValueError("smoothing_kwargs given without a smoothing method")
+    smoothing_kwargs = smoothing_kwargs or {}
+
+    groups = {}
+    for i, (wlen, wlen_ref) in enumerate(zip(wavelength_nm, deembed_wavelength_nm)):
+        groups.setdefault((len(wlen), len(wlen_ref)), []).append(i)
+
+    deembedded = [None] * len(wavelength_nm)
+    for (n_raw, n_ref), idx in groups.items():
+        wlen = np.array([wavelength_nm[i] for i in idx], dtype=float)
+        trans = np.array([transmission_db[i] for i in idx], dtype=dtype)
+        wlen_ref = np.array([deembed_wavelength_nm[i] for i in idx], dtype=float)
+        trans_ref = np.array([deembed_transmission_db[i] for i in idx], dtype=dtype)
+
+        if smoothing is not None:
+            trans = smooth_spectra(trans, method=smoothing, **smoothing_kwargs)
+            trans_ref = smooth_spectra(trans_ref, method=smoothing, **smoothing_kwargs)
+
+        # Only resample the reference sweeps whose grid differs from the raw grid
+        if n_raw == n_ref:
+            mismatch = ~np.all(
+                np.abs(wlen - wlen_ref) <= grid_tolerance_nm, axis=-1
+            )
+            if mismatch.any():
+                trans_ref[mismatch] = resample_spectra(
+                    wlen_ref[mismatch], trans_ref[mismatch], wlen[mismatch]
+                )
+        else:
+            trans_ref = resample_spectra(wlen_ref, trans_ref, wlen)
+
+        for j, i in enumerate(idx):
+            deembedded[i] = trans[j] - trans_ref[j]
+
+    return deembedded
@@ -0,0 +1,527 @@
+"""
+Differential equivalence checks of the fast pipeline paths
+
+Any faster de-embed, peak finding or fitting path must reproduce the
+WDMSweepMain spectra and WDMFitData FOMs of the reference implementation, a
+frozen copy of the original create_sweep_main_table and create_fit_table
+algorithms (see reference.py) that does not share code with the fast paths.
+
+verify_equivalence runs the reference and any number of candidate
+configurations (keyword arguments of run_candidate) on the same batch of sweeps
+and reports, per candidate:
+- deembed: max/median absolute transmission difference, number of sweeps
+  exceeding deembed_tolerance_db and number of sweeps of different length
+- every FOM: max/median absolute difference over the resonances found by both,
+  and the number exceeding its tolerance
+- rows: fit rows (measurement_id, sweep_id, resonance_id) missing from or extra
+  in the candidate, and failed fits
+- speedup: reference time / candidate time of de-embedding, fitting and both
+
+Before timing, scipy is imported and a sweep is fit once by every path, so no
+run pays the one-off import and warm-up costs. Every run is then repeated,
+alternating the reference and the candidates, and the minimum time is reported.
+
+Batches are either synthetic (synthetic_batch) or sampled drop-port sweeps of a
+database (sample_batch). For sampled sweeps, the reference and the candidates
+are also compared against the WDMSweepMain and WDMFitData rows already stored
+(load_stored, reported as "<name> vs stored", without speedups), e.g.
+    python -m photonics_db.pipelines.wdm.verify_equivalence --synthetic 200
+    python -m photonics_db.pipelines.wdm.verify_equivalence --wafer-id R2P0E438PLF7
+against john_dev, or against a local copy of the database with e.g.
+    --database postgresql://localhost:5432/photonics
+"""
+
+import time
+from functools import partial
+from typing import Callable, NamedTuple
+
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from photonics_db.tables.spectra import Spectra, load_spectra
+from photonics_db.tables.wdm import (
+    WDMFitData,
+    WDMMeasurements,
+    WDMSweepDeembed,
+    WDMSweepMain,
+    WDMSweepRaw,
+)
+
+from . import reference
+from .precision import fom_columns, resolve_dtype
+from .preprocess_sweeps import deembed_spectra
+
+deembed_tolerance_db = 1e-3
+fom_tolerances = {
+    "peak_wavelength_nm": 1e-3,
+    "fsr_nm": 1e-3,
+    "fwhm_nm": 1e-3,
+    "bw_1db_nm": 1e-3,
+    "crosstalk_db": 0.01,
+    "insertion_loss_db": 0.01,
+    "fit_rsquared": 1e-3,
+}
+
+# Candidate configurations checked by default
+candidates = {
+    "vectorized": dict(),
+    "float32": dict(precision="float32"),
+    "warm": dict(fit_strategy="warm"),
+    "float32+warm": dict(precision="float32", fit_strategy="warm"),
+}
+
+
+class SweepBatch(NamedTuple):
+    keys: list[tuple[int, int]]
+    wavelength_nm: list[np.ndarray]
+    transmission_db: list[np.ndarray]
+    deembed_wavelength_nm: list[np.ndarray]
+    deembed_transmission_db: list[np.ndarray]
+
+
+class PipelineResult(NamedTuple):
+    deembedded: list[np.ndarray]
+    fits: dict[tuple[int, int, int], dict]
+    n_failed: int
+    deembed_s: float
+    fit_s: float
+
+
+def synthetic_batch(
+    n_sweeps: int = 100,
+    n_points: int = 6001,
+    step_nm: float = 0.01,
+    sweeps_per_measurement: int = 4,
+    noise_db: float = 0.02,
+    seed: int = 0,
+) -> SweepBatch:
+    """Generate drop-port sweeps of ring resonators and their GCDE spectra.
+
+    Every measurement is a heater sweep: its sweeps share the resonances, which
+    red-shift by up to a tenth of the FSR over the sweeps.
+    """
+    from .create_fit_table import lorentzian, target_fsr_nm, target_wavelength_nm
+
+    rng = np.random.default_rng(seed)
+    wavelength_nm = target_wavelength_nm - 30 + step_nm * np.arange(n_points)
+    grating_db = -6 - np.square((wavelength_nm - target_wavelength_nm) / 20)
+
+    batch = SweepBatch([], [], [], [], [])
+    for i in range(n_sweeps):
+        measurement_id, sweep_id = divmod(i, sweeps_per_measurement)
+        if sweep_id == 0:
+            offset_nm = rng.uniform(0, target_fsr_nm)
+            gamma_nm = rng.uniform(0.05, 0.2)
+            height = rng.uniform(0.5, 0.95)
+        shift_nm = 0.1 * target_fsr_nm * sweep_id / sweeps_per_measurement
+        centers_nm = wavelength_nm[0] + offset_nm + shift_nm
+        centers_nm = centers_nm + target_fsr_nm * np.arange(
+            (wavelength_nm[-1] - centers_nm) // target_fsr_nm + 1
+        )
+
+        transmission_w = 1e-4 + sum(
+            lorentzian(wavelength_nm, center, height * gamma_nm, gamma_nm)
+            for center in centers_nm
+        )
+        batch.keys.append((measurement_id, sweep_id))
+        batch.wavelength_nm.append(wavelength_nm)
+        batch.transmission_db.append(
+            10 * np.log10(transmission_w)
+            + grating_db
+            + noise_db * rng.standard_normal(n_points)
+        )
+        batch.deembed_wavelength_nm.append(wavelength_nm)
+        batch.deembed_transmission_db.append(
+            grating_db + noise_db * rng.standard_normal(n_points)
+        )
+
+    return batch
+
+
+def _spectra_by_key(spectra: Spectra, key_names: tuple[str, ...]) -> dict:
+    """Index the (unpadded) spectra of a load_spectra result by primary key."""
+    keys = zip(*[spectra.metadata[name].tolist() for name in key_names])
+    return {
+        key: (spectra.wavelength_nm[i, :n], spectra.transmission_db[i, :n])
+        for i, (key, n) in enumerate(zip(keys, spectra.metadata["n_points"]))
+    }
+
+
+def sample_batch(
+    session: Session, *filters, sample_size: int = 100, seed: int = 0
+) -> SweepBatch:
+    """Sample drop-port raw sweeps and the GCDE sweeps they were de-embedded with.
+
+    Filters are where-clauses on WDMSweepMain or WDMMeasurements.
+    """
+    matches = session.execute(
+        sa.select(
+            WDMSweepMain.measurement_id,
+            WDMSweepMain.sweep_id,
+            WDMSweepMain.deembed_id,
+        )
+        .join(
+            WDMMeasurements,
+            WDMMeasurements.measurement_id == WDMSweepMain.measurement_id,
+        )
+        .where(WDMSweepMain.port_type == "drop", *filters)
+        .order_by(WDMSweepMain.measurement_id, WDMSweepMain.sweep_id)
+    ).all()
+    rng = np.random.default_rng(seed)
+    sample = np.sort(
+        rng.choice(len(matches), size=min(sample_size, len(matches)), replace=False)
+    )
+    matches = [matches[i] for i in sample]
+    if not matches:
+        return SweepBatch([], [], [], [], [])
+
+    raw = load_spectra(
+        session,
+        sa.tuple_(WDMSweepRaw.measurement_id, WDMSweepRaw.sweep_id).in_(
+            [(mid, sid) for mid, sid, _ in matches]
+        ),
+        table=WDMSweepRaw,
+    )
+    deembed = load_spectra(
+        session,
+        WDMSweepDeembed.deembed_id.in_({did for _, _, did in matches}),
+        table=WDMSweepDeembed,
+    )
+
+    raw_by_key = _spectra_by_key(raw, ("measurement_id", "sweep_id"))
+    deembed_by_key = _spectra_by_key(deembed, ("deembed_id",))
+
+    batch = SweepBatch([], [], [], [], [])
+    for measurement_id, sweep_id, deembed_id in matches:
+        wavelength_nm, transmission_db = raw_by_key[(measurement_id, sweep_id)]
+        deembed_wavelength_nm, deembed_transmission_db = deembed_by_key[
+            (deembed_id,)
+        ]
+        batch.keys.append((measurement_id, sweep_id))
+        batch.wavelength_nm.append(wavelength_nm)
+        batch.transmission_db.append(transmission_db)
+        batch.deembed_wavelength_nm.append(deembed_wavelength_nm)
+        batch.deembed_transmission_db.append(deembed_transmission_db)
+
+    return batch
+
+
+def _fit_batch(
+    batch: SweepBatch, deembedded: list[np.ndarray], **fit_kwargs
+) -> tuple[dict[tuple[int, int, int], dict], int]:
+    """Fit every sweep, seeding each from the previous sweep of its measurement."""
+    from .create_fit_table import fit_sweep
+
+    fits, n_failed, last_fits = {}, 0, {}
+    for (measurement_id, sweep_id), wavelength_nm, transmission_db in zip(
+        batch.keys, batch.wavelength_nm, deembedded
+    ):
+        if not len(transmission_db):
+            continue
+        rows, errors = fit_sweep(
+            measurement_id,
+            sweep_id,
+            wavelength_nm,
+            transmission_db,
+            seeds=last_fits.get(measurement_id),
+            **fit_kwargs,
+        )
+        if rows:
+            last_fits[measurement_id] = [row["fit_params"] for row in rows]
+        for row in rows:
+            fits[(measurement_id, sweep_id, row["resonance_id"])] = row
+        n_failed += len(errors)
+
+    return fits, n_failed
+
+
+def load_stored(session: Session, batch: SweepBatch) -> PipelineResult:
+    """Load the stored WDMSweepMain spectra and WDMFitData rows of a batch.
+
+    Sweeps without a WDMSweepMain row are left empty. The timings are NaN.
+    """
+    keys = sa.tuple_(WDMSweepMain.measurement_id, WDMSweepMain.sweep_id).in_(
+        batch.keys
+    )
+    main_by_key = _spectra_by_key(
+        load_spectra(session, keys, table=WDMSweepMain),
+        ("measurement_id", "sweep_id"),
+    )
+    deembedded = [main_by_key.get(key, (None, np.empty(0)))[1] for key in batch.keys]
+
+    rows = session.execute(
+        sa.select(
+            WDMFitData.measurement_id,
+            WDMFitData.sweep_id,
+            WDMFitData.resonance_id,
+            *[getattr(WDMFitData, fom) for fom in fom_columns],
+        ).where(
+            sa.tuple_(WDMFitData.measurement_id, WDMFitData.sweep_id).in_(batch.keys)
+        )
+    ).all()
+    fits = {
+        (row.measurement_id, row.sweep_id, row.resonance_id): row._asdict()
+        for row in rows
+    }
+
+    return PipelineResult(deembedded, fits, 0, np.nan, np.nan)
+
+
+def run_reference(batch: SweepBatch) -> PipelineResult:
+    """Run the frozen reference de-embed and fit, one sweep at a time."""
+    start = time.perf_counter()
+    deembedded = []
+    for transmission_db, deembed_transmission_db in zip(
+        batch.transmission_db, batch.deembed_transmission_db
+    ):
+        # The reference cannot de-embed sweeps of different length, these are
+        # left empty (and reported as length mismatches)
+        if len(transmission_db) != len(deembed_transmission_db):
+            deembedded.append(np.empty(0))
+            continue
+        deembedded.append(
+            reference.deembed_sweep(transmission_db, deembed_transmission_db)
+        )
+    deembed_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fits, n_failed = {}, 0
+    for (measurement_id, sweep_id), wavelength_nm, transmission_db in zip(
+        batch.keys, batch.wavelength_nm, deembedded
+    ):
+        if not len(transmission_db):
+            continue
+        rows, errors = reference.fit_sweep(
+            measurement_id, sweep_id, wavelength_nm, transmission_db
+        )
+        for row in rows:
+            fits[(measurement_id, sweep_id, row["resonance_id"])] = row
+        n_failed += len(errors)
+    fit_s = time.perf_counter() - start
+
+    return PipelineResult(deembedded, fits, n_failed, deembed_s, fit_s)
+
+
+def run_candidate(
+    batch: SweepBatch,
+    smoothing: str | None = None,
+    precision: str = "float64",
+    fit_strategy: str = "fixed",
+    downsample_factor: int = 1,
+    smoothing_kwargs: dict | None = None,
+) -> PipelineResult:
+    """Run the production de-embed and fit stages with the given options."""
+    dtype = resolve_dtype(precision)
+
+    start = time.perf_counter()
+    deembedded = deembed_spectra(
+        batch.wavelength_nm,
+        batch.transmission_db,
+        batch.deembed_wavelength_nm,
+        batch.deembed_transmission_db,
+        smoothing=smoothing,
+        dtype=dtype,
+        smoothing_kwargs=smoothing_kwargs,
+    )
+    deembed_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fits, n_failed = _fit_batch(
+        batch,
+        deembedded,
+        downsample_factor=downsample_factor,
+        dtype=dtype,
+        strategy=fit_strategy,
+    )
+    fit_s = time.perf_counter() - start
+
+    return PipelineResult(deembedded, fits, n_failed, deembed_s, fit_s)
+
+
+def _diff_stats(diffs: list[float], tolerance: float) -> dict[str, float]:
+    diffs = np.array(diffs, dtype=float)
+    return {
+        "max_abs_diff": float(diffs.max()) if diffs.size else np.nan,
+        "median_abs_diff": float(np.median(diffs)) if diffs.size else np.nan,
+        "exceeding": int(np.sum(diffs > tolerance)),
+        "tolerance": tolerance,
+    }
+
+
+def compare_results(
+    reference: PipelineResult, candidate: PipelineResult
+) -> dict[str, dict[str, float]]:
+    """Compare a candidate result against the reference result."""
+    deembed_diffs, length_mismatches = [], 0
+    for expected, actual in zip(reference.deembedded, candidate.deembedded):
+        if len(expected) != len(actual):
+            length_mismatches += 1
+            continue
+        deembed_diffs.append(
+            np.nanmax(np.abs(np.asarray(actual, dtype=float) - expected), initial=0)
+        )
+    report = {
+        "deembed": dict(
+            _diff_stats(deembed_diffs, deembed_tolerance_db),
+            length_mismatches=length_mismatches,
+        )
+    }
+
+    common = reference.fits.keys() & candidate.fits.keys()
+    for fom in fom_columns:
+        diffs = []
+        for key in common:
+            expected, actual = reference.fits[key][fom], candidate.fits[key][fom]
+            if (expected is None) != (actual is None):
+                diffs.append(np.inf)
+            elif expected is not None:
+                diff = abs(actual - expected)
+                # Both NaN (e.g. the FSR of the last resonance) is a match
+                diffs.append(0 if np.isnan(expected) and np.isnan(actual) else diff)
+        report[fom] = _diff_stats(diffs, fom_tolerances[fom])
+
+    report["rows"] = {
+        "reference": len(reference.fits),
+        "missing": len(reference.fits.keys() - candidate.fits.keys()),
+        "extra": len(candidate.fits.keys() - reference.fits.keys()),
+        "failed_fits": candidate.n_failed - reference.n_failed,
+    }
+    report["speedup"] = {
+        "deembed": reference.deembed_s / max(candidate.deembed_s, 1e-9),
+        "fit": reference.fit_s / max(candidate.fit_s, 1e-9),
+        "total": (reference.deembed_s + reference.fit_s)
+        / max(candidate.deembed_s + candidate.fit_s, 1e-9),
+    }
+
+    return report
+
+
+def is_equivalent(report: dict[str, dict[str, float]]) -> bool:
+    """Whether a candidate matches the reference within all tolerances."""
+    return (
+        report["deembed"]["length_mismatches"] == 0
+        and all(report[name]["exceeding"] == 0 for name in ("deembed", *fom_columns))
+        and report["rows"]["missing"] == 0
+        and report["rows"]["extra"] == 0
+    )
+
+
+def _warm_up(batch: SweepBatch):
+    """Import scipy and fit one sweep with every path before anything is timed."""
+    from .create_fit_table import fit_sweep
+
+    if not batch.keys:
+        return
+    (measurement_id, sweep_id), wavelength_nm = batch.keys[0], batch.wavelength_nm[0]
+    transmission_db = batch.transmission_db[0]
+    reference.fit_sweep(measurement_id, sweep_id, wavelength_nm, transmission_db)
+    fit_sweep(measurement_id, sweep_id, wavelength_nm, transmission_db)
+
+
+def _fastest_runs(
+    runs: dict[str, Callable[[], PipelineResult]], repeats: int
+) -> dict[str, PipelineResult]:
+    """Run every callable repeats times, alternating between them.
+
+    Returns the result of the first run with the minimum times over all runs.
+    """
+    results = {}
+    for _ in range(repeats):
+        for name, run in runs.items():
+            result = run()
+            if name in results:
+                first = results[name]
+                result = first._replace(
+                    deembed_s=min(first.deembed_s, result.deembed_s),
+                    fit_s=min(first.fit_s, result.fit_s),
+                )
+            results[name] = result
+
+    return results
+
+
+def verify_equivalence(
+    batch: SweepBatch,
+    candidates: dict[str, dict] = candidates,
+    repeats: int = 3,
+    stored: PipelineResult | None = None,
+) -> dict[str, dict[str, dict[str, float]]]:
+    """Compare every candidate configuration against the reference on a batch.
+
+    If the stored result of the batch is given (see load_stored), the reference
+    and every candidate are also compared against it.
+    """
+    _warm_up(batch)
+    results = _fastest_runs(
+        {
+            "reference": partial(run_reference, batch),
+            **{
+                name: partial(run_candidate, batch, **config)
+                for name, config in candidates.items()
+            },
+        },
+        repeats,
+    )
+    reference_result = results.pop("reference")
+
+    reports = {
+        name: compare_results(reference_result, result)
+        for name, result in results.items()
+    }
+    if stored is not None:
+        reports["reference vs stored"] = compare_results(stored, reference_result)
+        for name, result in results.items():
+            reports[f"{name} vs stored"] = compare_results(stored, result)
+
+    return reports
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    from photonics_db import database_address
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--synthetic", type=int, metavar="N_SWEEPS")
+    parser.add_argument("--wafer-id")
+    parser.add_argument("--database", default=database_address + "/john_dev")
+    parser.add_argument("--sample-size", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--candidate", choices=list(candidates), action="append")
+    args = parser.parse_args()
+
+    stored = None
+    if args.synthetic is not None:
+        batch = synthetic_batch(args.synthetic, seed=args.seed)
+    else:
+        from sqlalchemy import create_engine
+
+        filters = []
+        if args.wafer_id is not None:
+            filters.append(WDMMeasurements.wafer_id == args.wafer_id)
+
+        engine = create_engine(args.database)
+        with Session(engine) as sess:
+            batch = sample_batch(
+                sess, *filters, sample_size=args.sample_size, seed=args.seed
+            )
+            stored = load_stored(sess, batch)
+
+    selected = {name: candidates[name] for name in args.candidate or candidates}
+    reports = verify_equivalence(batch, selected, repeats=args.repeats, stored=stored)
+
+    print(f"Compared {len(batch.keys)} sweeps against the reference.")
+    all_equivalent = True
+    for name, report in reports.items():
+        equivalent = is_equivalent(report)
+        all_equivalent &= equivalent
+        print(f"{name}: {'equivalent' if equivalent else 'NOT equivalent'}")
+        for field, stats in report.items():
+            print(
+                f"  {field}",
+                ", ".join(f"{key}={value:0.3g}" for key, value in stats.items()),
+            )
+    sys.exit(0 if all_equivalent else 1)
@@ -0,0 +1,328 @@
+"""
+Distributed execution of the WDM pipeline stages via a database work queue
+
+Work units are (wafer_id, die_id) pairs stored in the wdm_work_queue table, one
+row per pipeline stage. Workers on any number of hosts claim pending units with
+SELECT ... FOR UPDATE SKIP LOCKED, so no two workers ever claim the same unit
+and no worker blocks on another's lock.
+
+Unit life cycle:
+    pending -> claimed -> done
+                       -> pending (failed, retried until max_attempts)
+                       -> failed
+While a unit is claimed, its worker updates heartbeat_at from a background
+thread. Claims whose heartbeat is older than stale_timeout_s (e.g. the worker
+host died) are returned to pending and picked up by another worker.
+
+All stages upsert their results, so re-running a unit after an abandoned
+claim is safe.
+
+Local test with several worker processes against one Postgres database:
+    python -m photonics_db.pipelines.wdm.work_queue --stage fit --workers 4
+"""
+
+import os
+import socket
+import threading
+import time
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from photonics_db.tables.wdm import WDMMeasurements, WDMWorkQueue
+
+from .create_fit_table import create_fit_table
+from .create_qc_table import create_qc_table
+from .create_sweep_main_table import create_sweep_main_table
+
+stages = {
+    "sweep_main": create_sweep_main_table,
+    "qc": create_qc_table,
+    "fit": create_fit_table,
+}
+
+
+def _unit_filter(stage: str, wafer_id: str, die_id: str):
+    return (
+        (WDMWorkQueue.stage == stage)
+        & (WDMWorkQueue.wafer_id == wafer_id)
+        & (WDMWorkQueue.die_id == die_id)
+    )
+
+
+def _claim_filter(stage: str, wafer_id: str, die_id: str, worker_id: str):
+    """Match a unit only while it is still claimed by worker_id."""
+    return (
+        _unit_filter(stage, wafer_id, die_id)
+        & (WDMWorkQueue.status == "claimed")
+        & (WDMWorkQueue.worker_id == worker_id)
+    )
+
+
+def populate_work_queue(session: Session, stage: str, requeue: bool = False):
+    """Add a work unit for every measured (wafer_id, die_id) to the queue.
+
+    Existing units are left untouched unless requeue is set, in which case they
+    are reset to pending.
+    """
+    units = session.execute(
+        sa.select(WDMMeasurements.wafer_id, WDMMeasurements.die_id).distinct()
+    ).all()
+    if not units:
+        return
+
+    stmt = insert(WDMWorkQueue).values(
+        [{"stage": stage, "wafer_id": w, "die_id": d} for w, d in units]
+    )
+    if requeue:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["stage", "wafer_id", "die_id"],
+            set_={
+                "status": "pending",
+                "attempts": 0,
+                "worker_id": None,
+                "error": None,
+            },
+        )
+    else:
+        stmt = stmt.on_conflict_do_nothing()
+    session.execute(stmt)
+    session.commit()
+
+
+def claim_work_unit(
+    session: Session, stage: str, worker_id: str
+) -> tuple[str, str] | None:
+    """Claim the next pending work unit, returning its (wafer_id, die_id)."""
+    unit = session.scalars(
+        sa.select(WDMWorkQueue)
+        .where(WDMWorkQueue.stage == stage)
+        .where(WDMWorkQueue.status == "pending")
+        .order_by(WDMWorkQueue.attempts, WDMWorkQueue.wafer_id, WDMWorkQueue.die_id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    ).first()
+    if unit is None:
+        session.rollback()
+        return None
+
+    key = (unit.wafer_id, unit.die_id)
+    unit.status = "claimed"
+    unit.worker_id = worker_id
+    unit.attempts += 1
+    unit.claimed_at = sa.func.now()
+    unit.heartbeat_at = sa.func.now()
+    session.commit()
+
+    return key
+
+
+def complete_work_unit(
+    session: Session, stage: str, wafer_id: str, die_id: str, worker_id: str
+) -> bool:
+    """Mark a unit done, returning False if worker_id no longer holds the claim."""
+    result = session.execute(
+        sa.update(WDMWorkQueue)
+        .where(_claim_filter(stage, wafer_id, die_id, worker_id))
+        .values(status="done", completed_at=sa.func.now(), error=None)
+    )
+    session.commit()
+
+    return result.rowcount > 0
+
+
+def fail_work_unit(
+    session: Session,
+    stage: str,
+    wafer_id: str,
+    die_id: str,
+    worker_id: str,
+    error: str,
+    max_attempts: int = 3,
+):
+    """Record a failed attempt and requeue the unit if attempts remain.
+
+    Nothing is recorded if worker_id no longer holds the claim.
+    """
+    session.execute(
+        sa.update(WDMWorkQueue)
+        .where(_claim_filter(stage, wafer_id, die_id, worker_id))
+        .values(
+            status=sa.case(
+                (WDMWorkQueue.attempts < max_attempts, "pending"), else_="failed"
+            ),
+            worker_id=None,
+            error=error,
+        )
+    )
+    session.commit()
+
+
+def release_stale_claims(
+    session: Session, stage: str, stale_timeout_s: float, max_attempts: int = 3
+) -> int:
+    """Return abandoned claims to the queue, returning the number released."""
+    result = session.execute(
+        sa.update(WDMWorkQueue)
+        .where(WDMWorkQueue.stage == stage)
+        .where(WDMWorkQueue.status == "claimed")
+        .where(
+            WDMWorkQueue.heartbeat_at
+            < sa.func.now() - sa.func.make_interval(0, 0, 0, 0, 0, 0, stale_timeout_s)
+        )
+        .values(
+            status=sa.case(
+                (WDMWorkQueue.attempts < max_attempts, "pending"), else_="failed"
+            ),
+            worker_id=None,
+            error="Claim abandoned (heartbeat timed out)",
+        )
+    )
+    session.commit()
+
+    return result.rowcount
+
+
+class Heartbeat:
+    """Periodically refresh heartbeat_at of a claimed unit from a background thread.
+
+    The heartbeat uses its own connection so it is independent of the worker's
+    (possibly long-running) transaction. If the claim is released by another
+    worker in the meantime, `lost` is set.
+    """
+
+    def __init__(
+        self,
+        engine: sa.Engine,
+        stage: str,
+        wafer_id: str,
+        die_id: str,
+        worker_id: str,
+        interval_s: float = 30,
+    ):
+        self.engine = engine
+        self.unit = (stage, wafer_id, die_id)
+        self.worker_id = worker_id
+        self.interval_s = interval_s
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            try:
+                with self.engine.begin() as conn:
+                    result = conn.execute(
+                        sa.update(WDMWorkQueue)
+                        .where(_claim_filter(*self.unit, self.worker_id))
+                        .values(heartbeat_at=sa.func.now())
+                    )
+            except Exception as e:
+                # Without heartbeats the claim goes stale, so assume it is lost
+                print(f"[{self.worker_id}] Heartbeat failed: {e}")
+                self.lost = True
+                return
+            if result.rowcount == 0:
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(
+    database_url: str,
+    stage: str,
+    worker_id: str | None = None,
+    heartbeat_interval_s: float = 30,
+    stale_timeout_s: float = 300,
+    max_attempts: int = 3,
+):
+    """Claim and process work units of a stage until the queue is drained."""
+    engine = sa.create_engine(database_url)
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    run_stage = stages[stage]
+
+    with Session(engine) as session:
+        while True:
+            release_stale_claims(session, stage, stale_timeout_s, max_attempts)
+            unit = claim_work_unit(session, stage, worker_id)
+
+            if unit is None:
+                # Other workers may still abandon their claims, so keep polling
+                # until no unit of this stage is in flight
+                in_flight = session.scalar(
+                    sa.select(sa.func.count())
+                    .select_from(WDMWorkQueue)
+                    .where(WDMWorkQueue.stage == stage)
+                    .where(WDMWorkQueue.status == "claimed")
+                )
+                session.rollback()
+                if not in_flight:
+                    break
+                time.sleep(heartbeat_interval_s)
+                continue
+
+            wafer_id, die_id = unit
+            print(f"[{worker_id}] Processing {stage} for {wafer_id} {die_id}")
+            measurement_ids = session.scalars(
+                sa.select(WDMMeasurements.measurement_id)
+                .where(WDMMeasurements.wafer_id == wafer_id)
+                .where(WDMMeasurements.die_id == die_id)
+            ).all()
+
+            try:
+                with Heartbeat(
+                    engine, stage, wafer_id, die_id, worker_id, heartbeat_interval_s
+                ) as heartbeat:
+                    run_stage(session, measurement_ids=measurement_ids)
+            except Exception as e:
+                session.rollback()
+                print(f"[{worker_id}] Failed {stage} for {wafer_id} {die_id}: {e}")
+                fail_work_unit(
+                    session, stage, wafer_id, die_id, worker_id, repr(e), max_attempts
+                )
+            else:
+                # A lost claim may already be re-claimed and running elsewhere,
+                # so leave its status to the new owner
+                if heartbeat.lost or not complete_work_unit(
+                    session, stage, wafer_id, die_id, worker_id
+                ):
+                    print(f"[{worker_id}] Claim on {wafer_id} {die_id} was lost.")
+
+    engine.dispose()
+    print(f"[{worker_id}] Queue drained.")
+
+
+if __name__ == "__main__":
+    import argparse
+    import multiprocessing
+
+    from photonics_db import database_address
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stage", choices=list(stages), default="fit")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--database", default=database_address + "/john_dev")
+    parser.add_argument("--requeue", action="store_true")
+    args = parser.parse_args()
+
+    engine = sa.create_engine(args.database)
+    with Session(engine) as sess:
+        populate_work_queue(sess, args.stage, requeue=args.requeue)
+    engine.dispose()
+
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(args.database, args.stage))
+        for _ in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
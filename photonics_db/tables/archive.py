@@ -0,0 +1,143 @@
+"""
+Cold storage of sweep spectra in compressed columnar files
+
+Archived sweep rows keep their metadata in Postgres, but their wavelength_nm and
+transmission_db arrays are set to NULL and archive_path points to a compressed
+.npz file (relative to photonics_db.archive_directory) holding the spectra of a
+whole wafer:
+
+    key_columns      names of the primary key columns
+    key_<column>     primary key column values, one per sweep
+    offsets          (n_sweeps + 1) start offsets of every sweep
+    wavelength_nm    concatenated wavelengths of all sweeps
+    transmission_db  concatenated transmissions of all sweeps
+
+Read-back is transparent: loading an archived row through the ORM fills its
+arrays from the archive, and load_spectra does the same for bulk loads.
+"""
+
+import functools
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from sqlalchemy import event
+from sqlalchemy.orm.attributes import set_committed_value
+
+import photonics_db
+
+spectra_columns = ("wavelength_nm", "transmission_db")
+
+# Number of decoded archive files kept in memory
+archive_cache_size = 2
+
+
+def resolve_archive_path(archive_path: str | Path) -> Path:
+    """Resolve an archive_path relative to the configured archive directory."""
+    return Path(photonics_db.archive_directory) / archive_path
+
+
+class SweepArchive:
+    """The decoded contents of an archive file, indexed by primary key."""
+
+    def __init__(self, path: str | Path):
+        with np.load(path) as data:
+            key_columns = data["key_columns"].tolist()
+            keys = zip(*[data[f"key_{name}"].tolist() for name in key_columns])
+            self.index = {key: i for i, key in enumerate(keys)}
+            self.offsets = data["offsets"]
+            self.wavelength_nm = data["wavelength_nm"]
+            self.transmission_db = data["transmission_db"]
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, key: tuple) -> tuple[np.ndarray, np.ndarray]:
+        i = self.index[key]
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.wavelength_nm[start:stop], self.transmission_db[start:stop]
+
+
+@functools.lru_cache(maxsize=archive_cache_size)
+def _open_archive(path: Path, mtime_ns: int) -> SweepArchive:
+    return SweepArchive(path)
+
+
+def open_archive(archive_path: str | Path) -> SweepArchive:
+    """Open an archive file, reusing the decoded file while it is unchanged."""
+    path = resolve_archive_path(archive_path)
+    return _open_archive(path, path.stat().st_mtime_ns)
+
+
+def read_archived(
+    archive_path: str | Path, key: tuple
+) -> tuple[np.ndarray, np.ndarray]:
+    """Read the (wavelength_nm, transmission_db) of one archived sweep."""
+    return open_archive(archive_path)[key]
+
+
+def write_archive(
+    archive_path: str | Path,
+    keys: dict[str, np.ndarray],
+    wavelength_nm: list[np.ndarray],
+    transmission_db: list[np.ndarray],
+) -> Path:
+    """Write the spectra of a set of sweeps to an archive file.
+
+    keys maps every primary key column to its per-sweep values. The file is
+    written to a temporary file next to the target and atomically renamed, so
+    readers never see a partial archive. Returns the resolved path.
+    """
+    path = resolve_archive_path(archive_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    lengths = [len(values) for values in transmission_db]
+    if [len(values) for values in wavelength_nm] != lengths:
+        raise ValueError("Wavelength and transmission lengths do not match")
+    offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+
+    arrays = {f"key_{name}": np.asarray(values) for name, values in keys.items()}
+    arrays["key_columns"] = np.array(list(keys))
+    arrays["offsets"] = offsets
+    for name, values in zip(spectra_columns, (wavelength_nm, transmission_db)):
+        arrays[name] = (
+            np.concatenate([np.asarray(v, dtype=np.float64) for v in values])
+            if values
+            else np.empty(0)
+        )
+
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+    return path
+
+
+def _fill_archived(target):
+    archive_path = target.__dict__.get("archive_path")
+    if archive_path is None or target.__dict__.get("transmission_db") is not None:
+        return
+
+    key = tuple(target.__dict__[column.key] for column in target.__mapper__.primary_key)
+    for name, values in zip(spectra_columns, read_archived(archive_path, key)):
+        set_committed_value(target, name, values)
+
+
+def register_archive_loader(table: type):
+    """Fill the arrays of archived rows of a mapped class when they are loaded."""
+
+    @event.listens_for(table, "load")
+    def _load_archived(target, context):
+        _fill_archived(target)
+
+    @event.listens_for(table, "refresh")
+    def _refresh_archived(target, context, attrs):
+        _fill_archived(target)
@@ -2,36 +2,46 @@ import dataclasses
 import types
 
 import numpy as np
-from psycopg2.extensions import AsIs, register_adapter
+from sqlalchemy import event
 from sqlalchemy.orm import DeclarativeBase, MappedAsDataclass
+from sqlalchemy.pool import Pool
 
 
-# We have to tell psycopg2 how to handle numpy datatypes
-def addapt_numpy_float64(numpy_float64):
-    return AsIs(numpy_float64)
+_numpy_adapters_registered = False
 
 
-def addapt_numpy_int64(numpy_int64):
-    return AsIs(numpy_int64)
+def register_numpy_adapters():
+    """Tell psycopg2 how to handle numpy datatypes.
 
+    This is deferred until the first database connection so that importing the
+    table definitions does not import psycopg2.
+    """
+    global _numpy_adapters_registered
+    if _numpy_adapters_registered:
+        return
 
-def addapt_numpy_float32(numpy_float32):
-    return AsIs(numpy_float32)
+    from psycopg2.extensions import AsIs, register_adapter
 
+    def addapt_numpy_scalar(numpy_scalar):
+        return AsIs(numpy_scalar)
 
-def addapt_numpy_int32(numpy_int32):
-    return AsIs(numpy_int32)
+    def addapt_numpy_array(numpy_array):
+        return AsIs(numpy_array.tolist())
 
+    register_adapter(np.float64, addapt_numpy_scalar)
+    register_adapter(np.int64, addapt_numpy_scalar)
+    register_adapter(np.float32, addapt_numpy_scalar)
+    register_adapter(np.int32, addapt_numpy_scalar)
+    register_adapter(np.ndarray, addapt_numpy_array)
+    _numpy_adapters_registered = True
 
-def addapt_numpy_array(numpy_array):
-    return AsIs(numpy_array.tolist())
 
-
-register_adapter(np.float64, addapt_numpy_float64)
-register_adapter(np.int64, addapt_numpy_int64)
-register_adapter(np.float32, addapt_numpy_float32)
-register_adapter(np.int32, addapt_numpy_int32)
-register_adapter(np.ndarray, addapt_numpy_array)
+@event.listens_for(Pool, "connect")
+def _register_numpy_adapters_on_connect(dbapi_connection, connection_record):
+    # The listener sees the connections of every engine in the process, so leave
+    # other drivers (e.g. sqlite3) alone and never import psycopg2 for them
+    if type(dbapi_connection).__module__.split(".")[0] == "psycopg2":
+        register_numpy_adapters()
 
 
 class Base(MappedAsDataclass, DeclarativeBase):
@@ -0,0 +1,379 @@
+"""
+Binary bulk fetch of sweep spectra into 2-D numpy arrays
+
+Loading spectra through the ORM creates one Python float per array element.
+load_spectra instead streams the rows with COPY (SELECT ...) TO STDOUT WITH
+BINARY and decodes every float8[] payload straight into numpy arrays as the
+rows arrive, so the COPY stream is never held in memory. Rows are decoded into
+blocks of block_rows sweeps, which are copied into the final (n_sweeps x
+n_points) array and released one at a time; the peak memory is about the size
+of the result. The scalar columns are returned as a numpy structured array.
+
+Usage:
+    spectra = load_spectra(
+        session,
+        WDMMeasurements.wafer_id == "R2P0E438PLF7",
+        table=WDMSweepMain,
+    )
+    spectra.metadata["measurement_id"], spectra.transmission_db[:, :10]
+
+Sweeps shorter than the longest sweep are padded with NaN; their length is
+given by metadata["n_points"]. The spectra of archived sweeps (see archive.py)
+are read back from their archive files.
+"""
+
+import struct
+from typing import NamedTuple
+
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from photonics_db.tables.archive import read_archived
+from photonics_db.tables.base import Base
+from photonics_db.tables.wdm import WDMMeasurements, WDMSweepMain
+
+spectra_columns = ("wavelength_nm", "transmission_db")
+
+_copy_signature = b"PGCOPY\n\xff\r\n\x00"
+
+# float8[] elements are stored as (int32 length, float8 value) pairs
+_float8_element = np.dtype([("length", ">i4"), ("value", ">f8")])
+
+# Number of sweeps decoded into each block of a streamed load
+block_rows = 256
+
+
+class Spectra(NamedTuple):
+    metadata: np.ndarray
+    wavelength_nm: np.ndarray
+    transmission_db: np.ndarray
+
+
+def _scalar_dtype(column: sa.Column) -> np.dtype:
+    """Return the (big-endian) binary COPY dtype of a scalar column."""
+    column_type = column.type
+    if isinstance(column_type, sa.BigInteger):
+        return np.dtype(">i8")
+    elif isinstance(column_type, sa.SmallInteger):
+        return np.dtype(">i2")
+    elif isinstance(column_type, sa.Integer):
+        return np.dtype(">i4")
+    elif isinstance(column_type, sa.Float):
+        return np.dtype(">f8")
+    elif isinstance(column_type, sa.Boolean):
+        return np.dtype("?")
+    elif isinstance(column_type, sa.String):
+        return np.dtype(object)
+    raise TypeError(f"Unsupported column type {column_type} for {column.name}")
+
+
+def _metadata_columns(table: type[Base]) -> list[sa.Column]:
+    return [
+        column
+        for column in sa.inspect(table).columns
+        if column.name not in spectra_columns
+        and not isinstance(column.type, sa.ARRAY)
+    ]
+
+
+def _null_value(dtype: np.dtype):
+    if dtype == object:
+        return None
+    return np.nan if dtype.kind == "f" else 0
+
+
+def _decode_float8_array(buffer: memoryview, offset: int, out: np.ndarray) -> int:
+    """Decode a binary float8[] value into out, returning the number of elements."""
+    ndim, has_null, _ = struct.unpack_from(">iii", buffer, offset)
+    if ndim == 0:
+        return 0
+    if ndim != 1:
+        raise ValueError(f"Expected a 1-D array, got {ndim} dimensions")
+    (n_elements,) = struct.unpack_from(">i", buffer, offset + 12)
+    offset += 20
+
+    if not has_null:
+        elements = np.frombuffer(
+            buffer, dtype=_float8_element, count=n_elements, offset=offset
+        )
+        out[:n_elements] = elements["value"]
+    else:
+        # NULL elements have length -1 and no payload, so the stride is irregular
+        for i in range(n_elements):
+            (element_length,) = struct.unpack_from(">i", buffer, offset)
+            offset += 4
+            if element_length < 0:
+                out[i] = np.nan
+            else:
+                (out[i],) = struct.unpack_from(">d", buffer, offset)
+                offset += element_length
+
+    return n_elements
+
+
+def _copy_data_offset(buffer: memoryview) -> int | None:
+    """Validate the binary COPY header, returning the offset of the first row.
+
+    Returns None if the buffer does not hold the whole header yet.
+    """
+    header_length = len(_copy_signature) + 8
+    if len(buffer) < header_length:
+        return None
+    if bytes(buffer[: len(_copy_signature)]) != _copy_signature:
+        raise ValueError("Invalid binary COPY signature")
+    (extension_length,) = struct.unpack_from(">i", buffer, len(_copy_signature) + 4)
+    if len(buffer) < header_length + extension_length:
+        return None
+    return header_length + extension_length
+
+
+def _row_end(buffer: memoryview, offset: int) -> int | None:
+    """Return the end offset of the COPY row (or trailer) starting at offset.
+
+    Returns None if the buffer does not hold the whole row yet.
+    """
+    if len(buffer) < offset + 2:
+        return None
+    (n_fields,) = struct.unpack_from(">h", buffer, offset)
+    offset += 2
+    if n_fields == -1:
+        return offset
+
+    for _ in range(n_fields):
+        if len(buffer) < offset + 4:
+            return None
+        (length,) = struct.unpack_from(">i", buffer, offset)
+        offset += 4 + max(length, 0)
+    return offset if offset <= len(buffer) else None
+
+
+def _array_length(buffer: memoryview, offset: int) -> int:
+    """Return the number of elements of a binary 1-D array value."""
+    (ndim,) = struct.unpack_from(">i", buffer, offset)
+    if ndim == 0:
+        return 0
+    (n_elements,) = struct.unpack_from(">i", buffer, offset + 12)
+    return n_elements
+
+
+class _SpectraBlock:
+    """A block of up to block_rows decoded sweeps."""
+
+    def __init__(self, metadata_dtype: np.dtype, dtype: np.dtype, n_points: int):
+        self.metadata = np.zeros(block_rows, dtype=metadata_dtype)
+        # Wavelength grids stay float64 (float32 only resolves ~0.1pm near 1580nm)
+        self.spectra = [
+            np.full((block_rows, n_points), np.nan, dtype=np.float64),
+            np.full((block_rows, n_points), np.nan, dtype=dtype),
+        ]
+        self.n_rows = 0
+
+    def widen(self, n_points: int):
+        padding = ((0, 0), (0, n_points - self.spectra[0].shape[1]))
+        self.spectra = [
+            np.pad(out, padding, constant_values=np.nan) for out in self.spectra
+        ]
+
+
+class _CopyDecoder:
+    """File-like sink for copy_expert that decodes binary COPY rows on arrival.
+
+    Only the bytes of incomplete rows are kept between writes.
+    """
+
+    def __init__(
+        self, metadata_dtypes: list[np.dtype], metadata_dtype: np.dtype, dtype: np.dtype
+    ):
+        self.metadata_dtypes = metadata_dtypes
+        self.metadata_dtype = metadata_dtype
+        self.dtype = dtype
+        self.pending = bytearray()
+        self.data_offset = None
+        self.done = False
+        self.blocks = []
+        self.n_points = 0
+
+    def write(self, data: bytes) -> int:
+        self.pending += data
+        buffer = memoryview(self.pending)
+        try:
+            offset = 0
+            if self.data_offset is None:
+                self.data_offset = _copy_data_offset(buffer)
+                if self.data_offset is None:
+                    return len(data)
+                offset = self.data_offset
+            while not self.done:
+                end = _row_end(buffer, offset)
+                if end is None:
+                    break
+                if struct.unpack_from(">h", buffer, offset)[0] == -1:
+                    self.done = True
+                else:
+                    self._decode_row(buffer, offset)
+                offset = end
+        finally:
+            buffer.release()
+        del self.pending[:offset]
+
+        return len(data)
+
+    def _decode_row(self, buffer: memoryview, offset: int):
+        block = self.blocks[-1] if self.blocks else None
+        if block is None or block.n_rows == block_rows:
+            block = _SpectraBlock(self.metadata_dtype, self.dtype, self.n_points)
+            self.blocks.append(block)
+        metadata, row = block.metadata, block.n_rows
+        offset += 2
+
+        for name, dtype in zip(metadata.dtype.names, self.metadata_dtypes):
+            (length,) = struct.unpack_from(">i", buffer, offset)
+            offset += 4
+            if length < 0:
+                value = _null_value(dtype)
+            elif dtype == object:
+                value = bytes(buffer[offset : offset + length]).decode()
+            else:
+                value = np.frombuffer(buffer, dtype=dtype, count=1, offset=offset)[0]
+            metadata[name][row] = value
+            offset += max(length, 0)
+
+        n_points = 0
+        for i in range(len(block.spectra)):
+            (length,) = struct.unpack_from(">i", buffer, offset)
+            offset += 4
+            if length >= 0:
+                n_elements = _array_length(buffer, offset)
+                if n_elements > block.spectra[i].shape[1]:
+                    block.widen(n_elements)
+                n_points = _decode_float8_array(buffer, offset, block.spectra[i][row])
+                offset += length
+        metadata["n_points"][row] = n_points
+        self.n_points = max(self.n_points, n_points)
+        block.n_rows += 1
+
+    def result(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Assemble the blocks into (metadata, wavelength_nm, transmission_db).
+
+        Every block is released as soon as it has been copied, and the output
+        pages are only touched by these copies, so the blocks and the output
+        are never both fully resident.
+        """
+        if not self.done:
+            raise ValueError("Incomplete binary COPY stream")
+        n_sweeps = sum(block.n_rows for block in self.blocks)
+        metadata = np.empty(n_sweeps, dtype=self.metadata_dtype)
+        spectra = [
+            np.empty((n_sweeps, self.n_points), dtype=np.float64),
+            np.empty((n_sweeps, self.n_points), dtype=self.dtype),
+        ]
+
+        row = 0
+        while self.blocks:
+            block = self.blocks.pop(0)
+            rows = slice(row, row + block.n_rows)
+            metadata[rows] = block.metadata[: block.n_rows]
+            for out, values in zip(spectra, block.spectra):
+                n_points = values.shape[1]
+                out[rows, :n_points] = values[: block.n_rows]
+                out[rows, n_points:] = np.nan
+            row += block.n_rows
+            del block
+
+        return metadata, spectra[0], spectra[1]
+
+
+def _fill_archived(
+    table: type[Base],
+    metadata: np.ndarray,
+    wavelength_nm: np.ndarray,
+    transmission_db: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Read the spectra of archived rows, widening the arrays if needed."""
+    archived = [
+        i for i, archive_path in enumerate(metadata["archive_path"]) if archive_path
+    ]
+    if not archived:
+        return wavelength_nm, transmission_db
+
+    key_names = [column.name for column in sa.inspect(table).primary_key]
+    spectra = [
+        read_archived(
+            metadata["archive_path"][i], tuple(metadata[name][i] for name in key_names)
+        )
+        for i in archived
+    ]
+
+    n_points = max(len(transmission) for _, transmission in spectra)
+    if n_points > transmission_db.shape[1]:
+        padding = ((0, 0), (0, n_points - transmission_db.shape[1]))
+        wavelength_nm = np.pad(wavelength_nm, padding, constant_values=np.nan)
+        transmission_db = np.pad(transmission_db, padding, constant_values=np.nan)
+
+    for i, (wavelength, transmission) in zip(archived, spectra):
+        wavelength_nm[i, : len(wavelength)] = wavelength
+        transmission_db[i, : len(transmission)] = transmission
+        metadata["n_points"][i] = len(transmission)
+
+    return wavelength_nm, transmission_db
+
+
+def load_spectra(
+    session: Session,
+    *filters,
+    table: type[Base] = WDMSweepMain,
+    dtype: np.dtype = np.float64,
+) -> Spectra:
+    """Load all spectra of a sweep table matching the filters.
+
+    Filters are SQLAlchemy where-clauses. Tables keyed by measurement_id are
+    joined to WDMMeasurements, so filters may also use its columns (e.g.
+    wafer_id or die_id). Rows are ordered by primary key. The transmission is
+    returned as dtype, the wavelengths always as float64.
+    """
+    metadata_columns = _metadata_columns(table)
+    metadata_dtypes = [_scalar_dtype(column) for column in metadata_columns]
+
+    query = sa.select(
+        *[getattr(table, column.name) for column in metadata_columns],
+        *[getattr(table, name) for name in spectra_columns],
+    )
+    if hasattr(table, "measurement_id"):
+        query = query.join(
+            WDMMeasurements,
+            WDMMeasurements.measurement_id == table.measurement_id,
+        )
+    for clause in filters:
+        query = query.where(clause)
+    query = query.order_by(*sa.inspect(table).primary_key)
+
+    # Stream the rows in the binary COPY format, decoding them as they arrive.
+    # The output arrays are sized from the stream itself, so rows committed
+    # concurrently cannot make them disagree with the data.
+    connection = session.connection()
+    compiled = query.compile(
+        dialect=connection.dialect, compile_kwargs={"render_postcompile": True}
+    )
+    decoder = _CopyDecoder(
+        metadata_dtypes,
+        np.dtype(
+            [
+                (column.name, dtype.newbyteorder("=") if dtype != object else dtype)
+                for column, dtype in zip(metadata_columns, metadata_dtypes)
+            ]
+            + [("n_points", np.int32)]
+        ),
+        dtype,
+    )
+    with connection.connection.dbapi_connection.cursor() as cursor:
+        sql = cursor.mogrify(str(compiled), compiled.params).decode()
+        cursor.copy_expert(f"COPY ({sql}) TO STDOUT WITH BINARY", decoder)
+    metadata, wavelength_nm, transmission_db = decoder.result()
+
+    if "archive_path" in metadata.dtype.names:
+        wavelength_nm, transmission_db = _fill_archived(
+            table, metadata, wavelength_nm, transmission_db
+        )
+
+    return Spectra(metadata, wavelength_nm, transmission_db)
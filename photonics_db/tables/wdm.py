@@ -12,6 +12,7 @@ from sqlalchemy import (
 )
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
+from photonics_db.tables.archive import register_archive_loader
 from photonics_db.tables.base import Base
 
 
@@ -115,8 +116,9 @@ class WDMSweepRaw(Base):
     output: Mapped[int]
     voltage_v: Mapped[float | None]
     current_ma: Mapped[float | None]
-    wavelength_nm: Mapped[np.ndarray] = mapped_column(ARRAY(Float))
-    transmission_db: Mapped[np.ndarray] = mapped_column(ARRAY(Float))
+    wavelength_nm: Mapped[np.ndarray] = mapped_column(ARRAY(Float), nullable=True)
+    transmission_db: Mapped[np.ndarray] = mapped_column(ARRAY(Float), nullable=True)
+    archive_path: Mapped[str | None] = mapped_column(default=None)
 
 
 class WDMSweepDeembed(Base):
@@ -131,8 +133,14 @@ class WDMSweepDeembed(Base):
     fiber_height_um: Mapped[float]
     input: Mapped[int]
     output: Mapped[int]
-    wavelength_nm: Mapped[np.ndarray] = mapped_column(ARRAY(Float))
-    transmission_db: Mapped[np.ndarray] = mapped_column(ARRAY(Float))
+    wavelength_nm: Mapped[np.ndarray] = mapped_column(ARRAY(Float), nullable=True)
+    transmission_db: Mapped[np.ndarray] = mapped_column(ARRAY(Float), nullable=True)
+    archive_path: Mapped[str | None] = mapped_column(default=None)
+
+
+# Archived rows have NULL spectra, which are read back from their archive_path
+register_archive_loader(WDMSweepRaw)
+register_archive_loader(WDMSweepDeembed)
 
 
 class WDMSweepMain(Base):
@@ -175,6 +183,7 @@ class WDMFitData(Base):
     fit_params: Mapped[np.ndarray] = mapped_column(ARRAY(Float, dimensions=1))
     fit_covars: Mapped[np.ndarray] = mapped_column(ARRAY(Float, dimensions=1))
     fit_rsquared: Mapped[float]
+    fit_nfev: Mapped[int | None] = mapped_column(default=None)
 
     __table_args__ = (
         ForeignKeyConstraint(
@@ -183,3 +192,121 @@ class WDMFitData(Base):
         ),
         Base.__table_args__,
     )
+
+
+class WDMFitPreview(Base):
+    """Fits of downsampled sweeps, kept apart from the full-resolution fits."""
+
+    __tablename__ = "wdm_fit_preview"
+
+    measurement_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    sweep_id: Mapped[int] = mapped_column(primary_key=True)
+    downsample_factor: Mapped[int] = mapped_column(primary_key=True)
+    resonance_id: Mapped[int] = mapped_column(primary_key=True)
+    peak_wavelength_nm: Mapped[float]
+    fsr_nm: Mapped[float | None]
+    fwhm_nm: Mapped[float]
+    bw_1db_nm: Mapped[float]
+    crosstalk_db: Mapped[float]
+    insertion_loss_db: Mapped[float]
+    fit_params: Mapped[np.ndarray] = mapped_column(ARRAY(Float, dimensions=1))
+    fit_covars: Mapped[np.ndarray] = mapped_column(ARRAY(Float, dimensions=1))
+    fit_rsquared: Mapped[float]
+    fit_nfev: Mapped[int | None] = mapped_column(default=None)
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            [measurement_id, sweep_id],
+            [WDMSweepMain.measurement_id, WDMSweepMain.sweep_id],
+        ),
+        Base.__table_args__,
+    )
+
+
+class WDMSweepQC(Base):
+    __tablename__ = "wdm_sweep_qc"
+
+    measurement_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    sweep_id: Mapped[int] = mapped_column(primary_key=True)
+    max_transmission_db: Mapped[float | None]
+    noise_floor_db: Mapped[float | None]
+    dynamic_range_db: Mapped[float | None]
+    saturated_fraction: Mapped[float | None]
+    # Sweeps fit without screening only record their fit failures, with NULL
+    # metrics and passed
+    n_peaks: Mapped[int | None]
+    expected_peaks: Mapped[float | None]
+    deembed_fallback: Mapped[bool | None]
+    passed: Mapped[bool | None]
+    reason: Mapped[str | None]
+    fit_failures: Mapped[int] = mapped_column(default=0)
+    fit_error: Mapped[str | None] = mapped_column(default=None)
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            [measurement_id, sweep_id],
+            [WDMSweepMain.measurement_id, WDMSweepMain.sweep_id],
+        ),
+        Base.__table_args__,
+    )
+
+
+class WDMResonance(Base):
+    __tablename__ = "wdm_resonance"
+
+    measurement_id: Mapped[int] = mapped_column(
+        BigInteger,
+        ForeignKey("PEGASUS2.wdm_measurements.measurement_id"),
+        primary_key=True,
+    )
+    track_id: Mapped[int] = mapped_column(primary_key=True)
+    reference_wavelength_nm: Mapped[float]
+    n_sweeps: Mapped[int]
+    tuning_efficiency_nm_per_mw: Mapped[float | None]
+    thermal_shift_nm_per_k: Mapped[float | None]
+    # Identifies the resonance across the temperatures of its die and device
+    thermal_track_id: Mapped[int | None] = mapped_column(default=None)
+
+
+class WDMResonanceTrack(Base):
+    __tablename__ = "wdm_resonance_track"
+
+    measurement_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    sweep_id: Mapped[int] = mapped_column(primary_key=True)
+    resonance_id: Mapped[int] = mapped_column(primary_key=True)
+    track_id: Mapped[int] = mapped_column()
+    heater_power_mw: Mapped[float]
+    wavelength_shift_nm: Mapped[float]
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            [measurement_id, sweep_id, resonance_id],
+            [
+                WDMFitData.measurement_id,
+                WDMFitData.sweep_id,
+                WDMFitData.resonance_id,
+            ],
+        ),
+        ForeignKeyConstraint(
+            [measurement_id, track_id],
+            [WDMResonance.measurement_id, WDMResonance.track_id],
+        ),
+        Base.__table_args__,
+    )
+
+
+class WDMWorkQueue(Base):
+    __tablename__ = "wdm_work_queue"
+
+    stage: Mapped[str] = mapped_column(primary_key=True)
+    wafer_id: Mapped[str] = mapped_column(
+        ForeignKey("PEGASUS2.wafers.wafer_id"), primary_key=True
+    )
+    die_id: Mapped[str] = mapped_column(primary_key=True)
+    status: Mapped[str] = mapped_column(default="pending")
+    attempts: Mapped[int] = mapped_column(default=0)
+    worker_id: Mapped[str | None] = mapped_column(default=None)
+    claimed_at: Mapped[datetime.datetime | None] = mapped_column(default=None)
+    heartbeat_at: Mapped[datetime.datetime | None] = mapped_column(default=None)
+    completed_at: Mapped[datetime.datetime | None] = mapped_column(default=None)
+    error: Mapped[str | None] = mapped_column(default=None)
@@ -0,0 +1,103 @@
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from photonics_db.tables.base import Base
+
+
+def _to_db_value(value):
+    """Convert numpy values to plain Python so the driver adapts them natively."""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class BatchedUpsertWriter:
+    """Collect rows of a mapped class and write them as multi-row upserts.
+
+    Rows are buffered as dicts (keyed by attribute name) and flushed as a single
+    INSERT ... ON CONFLICT (primary key) DO UPDATE, or DO NOTHING, statement,
+    which is sent in pages of page_size rows (insertmanyvalues). This replaces
+    one SELECT plus one INSERT/UPDATE per row with session.merge() by one round
+    trip per page, and no ORM objects are tracked by the session.
+
+    If update_columns is given, a conflicting row only has those columns
+    updated, the others keep their stored values.
+
+    Usage:
+        with BatchedUpsertWriter(session, WDMFitData) as writer:
+            for row in rows:
+                writer.add(row)
+        session.commit()
+    """
+
+    def __init__(
+        self,
+        session: Session,
+        table: type[Base],
+        page_size: int = 5000,
+        on_conflict: str = "update",
+        update_columns: list[str] | None = None,
+    ):
+        self.session = session
+        self.table = table
+        self.page_size = page_size
+        self.rows = []
+        self.n_written = 0
+
+        mapper = sa.inspect(table)
+        self.primary_key = [column.name for column in mapper.primary_key]
+
+        stmt = insert(table)
+        if on_conflict == "update":
+            stmt = stmt.on_conflict_do_update(
+                index_elements=self.primary_key,
+                set_={
+                    column.name: stmt.excluded[column.name]
+                    for column in mapper.columns
+                    if not column.primary_key
+                    and (update_columns is None or column.name in update_columns)
+                },
+            )
+        elif on_conflict == "nothing":
+            stmt = stmt.on_conflict_do_nothing(index_elements=self.primary_key)
+        else:
+            raise ValueError(f"Unrecognized on_conflict option '{on_conflict}'")
+        self.statement = stmt
+
+    def add(self, row: dict):
+        """Buffer a row, flushing once a full page has been collected."""
+        self.rows.append({key: _to_db_value(value) for key, value in row.items()})
+        if len(self.rows) >= self.page_size:
+            self.flush()
+
+    def flush(self) -> int:
+        """Write all buffered rows and return the number of rows written."""
+        # A statement may not touch the same row twice, so keep the last row
+        # written for each primary key
+        rows = {tuple(row[key] for key in self.primary_key): row for row in self.rows}
+        rows = list(rows.values())
+
+        n_rows = len(rows)
+        if n_rows:
+            self.session.execute(
+                self.statement,
+                rows,
+                execution_options={"insertmanyvalues_page_size": self.page_size},
+            )
+            self.rows = []
+            self.n_written += n_rows
+
+        return n_rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.rows = []